@@ -1,27 +1,38 @@
 from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_mail import Mail
 from flask_bootstrap import Bootstrap
-from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from flask_qrcode import QRcode
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
+from flask_socketio import SocketIO
+from app.lazy import LazyImport, LazyExtension
+from app.broker import Broker
+from app.presence import Presence
+from app.metrics import Metrics
+from app.rounds import Rounds
+from app.deck import Decks
+from app.database import engine_options, configure_engine
+from app.shards import NotificationShards
+from app.log import LogPipeline
 
 db = SQLAlchemy()
-migrate = Migrate()
+# slow to import and not needed by most workers, so imported when they are first used
+migrate = LazyExtension('flask_migrate', 'Migrate', 'migrate')
 login = LoginManager()
 login.login_view = 'auth.register'
 login.login_message = None #_l('Please introduce yourself :)')
-mail = Mail()
+mail = LazyExtension('flask_mail', 'Mail', 'mail')
 bootstrap = Bootstrap()
-moment = Moment()
 babel = Babel()
-qrcode = QRcode()
+qrcode = LazyImport('flask_qrcode', 'QRcode')
+socketio = SocketIO()
+broker = Broker()
+presence = Presence()
+metrics = Metrics()
+rounds = Rounds()
+decks = Decks()
+notification_shards = NotificationShards()
+log_pipeline = LogPipeline()
 
 def create_app(config_class=Config):
     ''' Creates an instance of the Flask app '''
@@ -29,14 +40,23 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.init_app(app)
+    configure_engine(app, db)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
-    moment.init_app(app)
     babel.init_app(app)
-    qrcode.init_app(app)
+    socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+                      message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
+    broker.init_app(app)
+    presence.init_app(app)
+    metrics.init_app(app)
+    rounds.init_app(app)
+    decks.init_app(app)
+    notification_shards.init_app(app)
+    log_pipeline.init_app(app)
 
     from app.models import User, Game, Notification
 
@@ -49,34 +69,17 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    if not app.debug and not app.testing:
+    from app import cli
+    cli.register(app)
 
-        # Email logging
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='WitM error notification',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+    # the background threads run in the processes that serve requests, not in the flask commands
+    if app.config['NOTIFICATION_PRUNE_INTERVAL'] and not app.testing:
+        from app import retention
+        app.before_first_request(lambda: retention.start_pruning(app))
 
-        # File logging
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/who-is-the-man.log', maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter( '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
-        app.logger.info('App started up')
+    if app.config['ROUND_SCHEDULER'] and not app.testing:
+        from app.rounds import start_scheduler
+        app.before_first_request(lambda: start_scheduler(app))
 
     return app
 
@@ -2,7 +2,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Email, ValidationError, EqualTo, Length
 from flask_babel import _, lazy_gettext as _l
-from app.models import Game
+from app import db
+from app.models import User, Game
 
 class UserRegistrationForm(FlaskForm):
 
@@ -15,9 +16,9 @@ class UserRegistrationForm(FlaskForm):
 
     def validate_username(self, name):
         ''' checks when joining a game that this username does not already exist in that game '''
-        if self.game:
-            if name.data in [x.username for x in self.game.players]:
-                raise ValidationError(_l('This username already exists in this game, please use another'))
+        if self.game and db.session.query(
+                User.query.filter_by(game_id=self.game.id, username=name.data).exists()).scalar():
+            raise ValidationError(_l('This username already exists in this game, please use another'))
 
 
 class CreateGameForm(FlaskForm):
@@ -26,6 +27,5 @@ class CreateGameForm(FlaskForm):
 
     def validate_name(self, name):
         ''' checks if a game name is already existing '''
-        game = Game.query.filter_by(name=name.data).first()
-        if game is not None:
+        if db.session.query(Game.query.filter_by(name=name.data).exists()).scalar():
             raise ValidationError(_l('This name already exists, please use another'))
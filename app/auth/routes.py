@@ -1,24 +1,113 @@
-from app import db
+from app import db, qrcode, presence
+from app.cache import app_cache
 from app.auth import bp
 from app.auth.forms import UserRegistrationForm, CreateGameForm
 from app.models import User, Game
-from flask import render_template, flash, redirect, url_for, request, abort, current_app
+from flask import render_template, flash, redirect, url_for, request, abort, current_app, make_response, jsonify
 from flask_login import current_user, login_user, logout_user, login_required
 from werkzeug.urls import url_parse
+from sqlalchemy.exc import IntegrityError
+from hashlib import md5
 import re, json
 from datetime import datetime
-from flask_babel import _
+from time import time
+from flask_babel import _, get_locale
 
 @bp.route('/')
 @bp.route('/index')
 @login_required
 def lobby():
-    # delete all notifications of new players joining
-    current_user.notifications.filter_by(name='new_player_joined').delete()
-    db.session.commit()
+    game = current_user.game
+    players_html, epoch = None, Game.token_epoch()
+    if game is not None:
+        presence.touch(current_user.id)
+        players_html = lobby_fragment(game, epoch)
 
     # render template
-    return render_template('auth/lobby.html', title="Welcome in the lobby")
+    return render_template('auth/lobby.html', title="Welcome in the lobby",
+                           game=game, players_html=players_html)
+
+def lobby_players(game):
+    ''' returns the players of the game as (id, username, is_host) and the ids of those
+    online; the players are cached until a player joins or the host changes '''
+    cache = app_cache('lobby_players', current_app.config['LOBBY_CACHE_SIZE'])
+    players = cache.get((game.id, game.players_version))
+    if players is None:
+        # load all players at once, the host is recognised by its role
+        host_role = current_app.config['ROLES']['HOST']
+        loaded = game.players.order_by(User.id).all()
+        players = [(p.id, p.username, p.role == host_role) for p in loaded]
+        last_seen = {p.id: p.last_seen for p in loaded}
+        cache.set((game.id, game.players_version), players)
+    else:
+        # players seen by other workers are only known from the database, so not cached
+        last_seen = dict(db.session.query(User.id, User.last_seen).filter(User.game_id == game.id))
+    online = tuple(id for id, _username, _is_host in players if presence.is_online(id, last_seen.get(id)))
+    return players, online
+
+def lobby_fragment(game, epoch):
+    ''' returns the rendered player list and invite block of the lobby, cached until a
+    player joins, the host changes, the join token is reissued or someone comes or goes '''
+    players, online = lobby_players(game)
+    cache = app_cache('lobby_fragments', current_app.config['LOBBY_CACHE_SIZE'])
+    key = (game.id, game.players_version, str(get_locale()), epoch, online)
+    html = cache.get(key)
+    if html is None:
+        join_url = url_for('auth.join_game', token=game.get_join_token(epoch=epoch), _external=True)
+        html = render_template('auth/_players.html', game=game, epoch=epoch, join_url=join_url, players=[
+            {'username': username, 'is_host': is_host, 'online': id in online}
+            for id, username, is_host in players])
+        cache.set(key, html)
+    return html
+
+@bp.route('/lobby/state')
+@login_required
+def lobby_state():
+    ''' returns the players of the game of the current user as JSON, with an ETag of the
+    players version and who is online, so unchanged lobbies are answered with a 304 '''
+    game = current_user.game
+    presence.touch(current_user.id)
+    if game is None:
+        response = jsonify({'game': None, 'players': []})
+        response.set_etag('none')
+    else:
+        players, online = lobby_players(game)
+        etag = '{}-{}-{}'.format(game.id, game.players_version,
+                                 md5(','.join(map(str, online)).encode()).hexdigest())
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+        else:
+            response = jsonify({'game': game.name, 'players': [
+                {'username': username, 'is_host': is_host, 'online': id in online}
+                for id, username, is_host in players]})
+            response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@bp.route('/join_game/qrcode/<int:game_id>/<int:epoch>.png')
+@login_required
+def join_qrcode(game_id, epoch):
+    ''' returns the QR code with the join link of the game as PNG '''
+    current_epoch = Game.token_epoch()
+    # only players can see the code, and only for the current epoch or a page rendered just before
+    if current_user.game_id != game_id or epoch not in (current_epoch, current_epoch - 1):
+        abort(404)
+
+    cache = app_cache('qrcodes', current_app.config['QRCODE_CACHE_SIZE'])
+    png = cache.get((game_id, epoch))
+    if png is None:
+        url = url_for('auth.join_game', token=current_user.game.get_join_token(epoch=epoch), _external=True)
+        png = qrcode.qrcode(url, mode='raw').getvalue()
+        cache.set((game_id, epoch), png)
+
+    response = make_response(png)
+    response.mimetype = 'image/png'
+    response.set_etag('{}-{}'.format(game_id, epoch))
+    response.cache_control.private = True
+    response.cache_control.max_age = max(0, (epoch + 1) * current_app.config['JOIN_TOKEN_EPOCH'] - int(time()))
+    return response.make_conditional(request)
 
 @bp.route('/register', methods=['GET', 'POST'])
 def register():
@@ -60,9 +149,15 @@ def create_game():
         game = Game(name=form.name.data)
         game.set_host(current_user)
         db.session.add(game)
-        db.session.commit()
-        flash(_('Created %(game_name)s', game_name=game.name))
-        return redirect(url_for('auth.lobby'))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another game got the name after it was validated
+            db.session.rollback()
+            form.name.errors.append(_('This name already exists, please use another'))
+        else:
+            flash(_('Created %(game_name)s', game_name=game.name))
+            return redirect(url_for('auth.lobby'))
 
     return render_template('auth/create_game.html', form=form, title='Create game')
 
@@ -72,16 +167,24 @@ def join_game(token):
     g = Game.verify_join_token(token)
     if g is None:
         abort(404)
-    # add notifications for all other users
-    for player in g.players.all():
-        player.add_notification('new_player_joined', {'username' : current_user.username})
+    # notify the other players through the game channel
+    g.add_notification('new_player_joined', {'username' : current_user.username})
 
     # add game to current user
     current_user.game = g
+    g.players_changed()
     if not current_user.role == current_app.config['ROLES']['HOST']:
         current_user.role = current_app.config['ROLES']['PLAYER']
-        flash(_('You joined %(game_name)s as a player', game_name=g.name))
+        message = _('You joined %(game_name)s as a player', game_name=g.name)
     else:
-        flash(_('You are the host of %(game_name)s', game_name=g.name))
-    db.session.commit()
+        message = _('You are the host of %(game_name)s', game_name=g.name)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # a player with the same name joined first, so join with another name
+        db.session.rollback()
+        logout_user()
+        flash(_('This username already exists in this game, please use another'))
+        return redirect(url_for('auth.register', next=url_for('auth.join_game', token=token)))
+    flash(message)
     return redirect(url_for('auth.lobby'))
@@ -0,0 +1,345 @@
+from collections import namedtuple
+from heapq import merge
+from time import time, sleep
+from bisect import insort
+from flask import current_app
+from flask.signals import Namespace
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event as sa_event
+import threading
+import json
+import os
+
+_signals = Namespace()
+# sent with the events of a session once they are published, for delivery over other transports
+events_published = _signals.signal('events-published')
+
+
+class Event(namedtuple('Event', 'channel channel_id seq name payload_json timestamp')):
+    ''' A notification as it is passed between requests '''
+
+    __slots__ = ()
+
+    def to_json(self):
+        ''' returns the event as JSON, splicing in the stored payload without decoding it '''
+        return '{{"name": {}, "data": {}, "channel": "{}", "seq": {}}}'.format(
+            json.dumps(self.name), self.payload_json, self.channel, self.seq)
+
+
+class _History(object):
+    ''' Recent events of a channel, complete for all sequence numbers after base '''
+
+    __slots__ = ('base', 'events', 'updated', 'synced')
+
+    def __init__(self, base):
+        self.base = base
+        self.events = []
+        self.updated = self.synced = time()
+
+
+class MemoryBackend(object):
+    ''' Keeps the recent events of every channel in memory
+
+    Other processes publish events this backend does not see, so with ttl (in seconds) a
+    history is only trusted for that long after it was started, and then read from the
+    database again. Channels without events for max_idle seconds are forgotten. '''
+
+    def __init__(self, history=100, gap_timeout=5, ttl=None, max_idle=300):
+        self.history = history
+        self.gap_timeout = gap_timeout
+        self.ttl = ttl
+        self.max_idle = max_idle
+        self.histories = {}
+        self.condition = threading.Condition()
+        self.swept = time()
+
+    def publish(self, events):
+        with self.condition:
+            self._sweep()
+            for e in events:
+                self._add(e)
+            self.condition.notify_all()
+
+    def _add(self, e):
+        history = self.histories.get((e.channel, e.channel_id))
+        if history is None:
+            history = self.histories[(e.channel, e.channel_id)] = _History(e.seq - 1)
+        if e.seq <= history.base or any(x.seq == e.seq for x in history.events):
+            return
+        # events can be committed out of order, so keep them sorted by seq
+        insort(history.events, e)
+        history.updated = time()
+        if len(history.events) > self.history:
+            history.base = history.events.pop(0).seq
+
+    def _sync(self, key):
+        ''' hook to pick up events published by other processes '''
+
+    def _forget(self, key):
+        del self.histories[key]
+
+    def _expired(self, history, now):
+        return history.updated < now - self.max_idle or \
+            self.ttl is not None and history.synced < now - self.ttl
+
+    def _sweep(self):
+        # at most every few seconds, so it does not cost a scan per call
+        now = time()
+        if now - self.swept < min(self.ttl or self.max_idle, self.max_idle):
+            return
+        self.swept = now
+        for key in [key for key, history in self.histories.items() if self._expired(history, now)]:
+            self._forget(key)
+
+    def _history(self, key):
+        self._sync(key)
+        history = self.histories.get(key)
+        if history is not None and self._expired(history, time()):
+            self._forget(key)
+            return None
+        return history
+
+    def seed(self, key, seq):
+        ''' records that there are no events up to seq that the backend has not seen '''
+        with self.condition:
+            self._sweep()
+            if self._history(key) is None:
+                self.histories[key] = _History(seq)
+
+    def head(self, key):
+        ''' returns the last sequence number of a channel, None if it is unknown '''
+        with self.condition:
+            history = self._history(key)
+            if history is None:
+                return None
+            return history.events[-1].seq if history.events else history.base
+
+    def read(self, key, since):
+        ''' returns the events of a channel after since, or None when the history
+        does not reach back that far '''
+        with self.condition:
+            history = self._history(key)
+            if history is None or since < history.base:
+                return None
+            events, expected = [], since + 1
+            for e in history.events:
+                if e.seq < expected:
+                    continue
+                # a missing seq is probably still being committed; give up waiting after gap_timeout
+                if e.seq > expected and time() - e.timestamp < self.gap_timeout:
+                    break
+                events.append(e)
+                expected = e.seq + 1
+            return events
+
+    def _ready(self, cursors):
+        for key, since in cursors.items():
+            head = self.head(key)
+            if head is not None and head > since:
+                return True
+        return False
+
+    def wait(self, cursors, timeout):
+        ''' blocks until one of the channels has events after its cursor, or until timeout '''
+        if self.ttl is not None:
+            # events of other processes are only found in the database
+            timeout = min(timeout, self.ttl)
+        with self.condition:
+            self.condition.wait_for(lambda: self._ready(cursors), timeout)
+
+    def prune(self, max_age):
+        ''' forgets channels without events for max_age seconds, returns how many '''
+        cutoff = time() - max_age
+        with self.condition:
+            stale = [key for key, history in self.histories.items() if history.updated < cutoff]
+            for key in stale:
+                del self.histories[key]
+        return len(stale)
+
+
+class FileBackend(MemoryBackend):
+    ''' Appends events to one file per channel, so the workers on one host share them;
+    the files of channels without events for max_idle seconds are removed '''
+
+    def __init__(self, directory, history=100, gap_timeout=5, poll_interval=0.2, tail_bytes=65536, max_idle=300):
+        # the files hold the events of all workers, so the histories stay complete
+        super().__init__(history, gap_timeout, max_idle=max_idle)
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.tail_bytes = tail_bytes
+        self.offsets = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '{}-{}.log'.format(*key))
+
+    def _forget(self, key):
+        super()._forget(key)
+        # read the tail of the file again when the channel is used again
+        self.offsets.pop(key, None)
+
+    def publish(self, events):
+        for e in events:
+            line = '{}\t{!r}\t{}\t{}\n'.format(e.seq, e.timestamp, e.name, e.payload_json)
+            # a single write with O_APPEND keeps lines of concurrent writers intact
+            fd = os.open(self._path((e.channel, e.channel_id)), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+        with self.condition:
+            self._sweep()
+            self.condition.notify_all()
+
+    def _sync(self, key):
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            inode, offset = self.offsets.get(key, (None, None))
+            size = stat.st_size
+            skip_partial = False
+            # start over if the file was pruned and created again
+            if offset is None or inode != stat.st_ino or offset > size:
+                # only read the tail of long files, older events come from the database
+                offset = max(0, size - self.tail_bytes)
+                skip_partial = offset > 0
+            f.seek(offset)
+            data = f.read()
+        # ignore a line that is still being written
+        end = data.rfind(b'\n') + 1
+        self.offsets[key] = (stat.st_ino, offset + end)
+        lines = data[:end].decode('utf-8').splitlines()
+        if skip_partial:
+            lines = lines[1:]
+        for line in lines:
+            seq, timestamp, name, payload_json = line.split('\t', 3)
+            self._add(Event(key[0], key[1], int(seq), name, payload_json, float(timestamp)))
+
+    def wait(self, cursors, timeout):
+        deadline = time() + timeout
+        while not self._ready(cursors) and time() < deadline:
+            sleep(min(self.poll_interval, max(0, deadline - time())))
+
+    def _sweep(self):
+        swept = self.swept
+        super()._sweep()
+        if self.swept != swept:
+            # readers of a removed file start over when it is created again
+            self._remove_files(self.swept - self.max_idle)
+
+    def _remove_files(self, cutoff):
+        removed = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if filename.endswith('.log') and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                # removed by another worker
+                pass
+        return removed
+
+    def prune(self, max_age):
+        ''' removes the files of channels without events for max_age seconds '''
+        with self.condition:
+            removed = self._remove_files(time() - max_age)
+            # the offsets of removed files are no longer valid
+            self.offsets.clear()
+            self.histories.clear()
+        return removed
+
+
+class Broker(object):
+    ''' Flask extension that passes notifications from the request that sends
+    them to the requests that deliver them '''
+
+    def init_app(self, app):
+        app.config.setdefault('NOTIFICATION_BROKER', 'memory')
+        app.config.setdefault('NOTIFICATION_BROKER_HISTORY', 100)
+        app.config.setdefault('NOTIFICATIONS_DURABLE', True)
+        app.config.setdefault('NOTIFICATION_BROKER_DIR', 'events')
+        app.config.setdefault('NOTIFICATION_BROKER_TTL', 5)
+        app.config.setdefault('NOTIFICATION_BROKER_IDLE', 300)
+        name = app.config['NOTIFICATION_BROKER']
+        history = app.config['NOTIFICATION_BROKER_HISTORY']
+        max_idle = app.config['NOTIFICATION_BROKER_IDLE']
+        if name == 'memory':
+            backend = MemoryBackend(history, ttl=app.config['NOTIFICATION_BROKER_TTL'] or None, max_idle=max_idle)
+        elif name == 'file':
+            backend = FileBackend(app.config['NOTIFICATION_BROKER_DIR'], history, max_idle=max_idle)
+        else:
+            raise ValueError('Unknown notification broker: {}'.format(name))
+        app.extensions['broker'] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions['broker']
+
+    def queue(self, session, event):
+        ''' publishes the event once the session is committed '''
+        session.info.setdefault('pending_events', []).append(event)
+
+    def head(self, channel, channel_id):
+        ''' returns the last sequence number of a channel, from the broker when it knows the
+        channel and else from the sequence counter of the user or game (or of its shard),
+        without reading the notifications '''
+        head = self.backend.head((channel, channel_id))
+        if head is None:
+            from app import db, notification_shards
+            from app.models import User, Game
+            if notification_shards.enabled:
+                head = notification_shards.channel_seq(channel, channel_id)
+            else:
+                model = Game if channel == 'game' else User
+                head = db.session.query(model.last_seq).filter(model.id == channel_id).scalar() or 0
+            # the events up to here are committed, older ones are read from the database
+            self.backend.seed((channel, channel_id), head)
+        return head
+
+    def page(self, user_id, user_since=0, game_id=None, game_since=0, limit=100):
+        ''' returns the events of a user and of the game (s)he is playing after the
+        given sequence numbers, at most limit per channel '''
+        channels = [('user', user_id, user_since)]
+        if game_id is not None:
+            channels.append(('game', game_id, game_since))
+        return list(merge(*[self._channel_page(*c, limit=limit) for c in channels],
+                          key=lambda e: e.timestamp))
+
+    def _channel_page(self, channel, channel_id, since, limit):
+        events = self.backend.read((channel, channel_id), since)
+        if events is not None:
+            return events[:limit]
+        if not current_app.config['NOTIFICATIONS_DURABLE']:
+            return []
+        # the broker does not know this far back, so catch up from the database
+        from app.models import Notification
+        events = [n.to_event() for n in Notification.channel_page(channel, channel_id, since, limit)]
+        if len(events) < limit:
+            # all events up to here have been read, newer ones will be published
+            head = events[-1].seq if events else Notification.channel_head(channel, channel_id)
+            self.backend.seed((channel, channel_id), head)
+        return events
+
+    def wait(self, user_id, user_since=0, game_id=None, game_since=0, timeout=1):
+        ''' blocks until there are events after the given sequence numbers, or until timeout '''
+        cursors = {('user', user_id): user_since}
+        if game_id is not None:
+            cursors[('game', game_id)] = game_since
+        self.backend.wait(cursors, timeout)
+
+
+@sa_event.listens_for(SignallingSession, 'after_commit')
+def _publish_pending(session):
+    events = session.info.pop('pending_events', None)
+    if events:
+        current_app.extensions['broker'].publish(events)
+        events_published.send(current_app._get_current_object(), events=events)
+
+
+@sa_event.listens_for(SignallingSession, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('pending_events', None)
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from flask import current_app
+from time import monotonic
+import threading
+
+_missing = object()
+
+
+class LRUCache(object):
+    ''' Thread-safe dict that holds at most maxsize items, dropping the least recently used '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def _lookup(self, key):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return _missing
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TTLCache(LRUCache):
+    ''' LRU cache whose items expire after a number of seconds '''
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def _lookup(self, key):
+        item = super()._lookup(key)
+        if item is _missing:
+            return _missing
+        expires, value = item
+        if expires < monotonic():
+            self.delete(key)
+            return _missing
+        return value
+
+    def set(self, key, value, ttl=None):
+        super().set(key, (monotonic() + (self.ttl if ttl is None else ttl), value))
+
+
+def app_cache(name, maxsize=1024, cache_class=LRUCache, **kwargs):
+    ''' returns the cache with the given name of the current app, creating it on first use '''
+    caches = current_app.extensions.setdefault('caches', {})
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = cache_class(maxsize, **kwargs)
+    return cache
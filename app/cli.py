@@ -0,0 +1,22 @@
+import click
+
+
+def register(app):
+
+    @app.cli.group()
+    def notifications():
+        ''' Notification maintenance commands. '''
+        pass
+
+    @notifications.command()
+    @click.option('--max-age', type=int, default=None,
+                  help='Age in seconds after which notifications are deleted.')
+    @click.option('--batch-size', type=int, default=None,
+                  help='Number of rows deleted per transaction.')
+    def prune(max_age, batch_size):
+        ''' Delete expired notifications and notifications of abandoned games. '''
+        from app.retention import prune_notifications
+        removed, seconds = prune_notifications(
+            max_age if max_age is not None else app.config['NOTIFICATION_RETENTION'],
+            batch_size or app.config['NOTIFICATION_PRUNE_BATCH_SIZE'])
+        click.echo('Removed {} notifications in {:.3f} s'.format(removed, seconds))
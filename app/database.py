@@ -0,0 +1,57 @@
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(config):
+    ''' returns the engine options of the database profile in the config
+
+    DATABASE_PROFILE 'auto' picks the profile that matches the database URL,
+    'default' keeps the defaults of SQLAlchemy. SQLALCHEMY_ENGINE_OPTIONS in the
+    config take precedence over the profile. '''
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    profile = config['DATABASE_PROFILE']
+    if profile == 'auto':
+        profile = url.get_backend_name()
+    if profile == 'sqlite':
+        options = {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+        if url.database not in (None, '', ':memory:'):
+            # keep connections open, so the pragmas are only set once per connection
+            options['connect_args']['check_same_thread'] = False
+            options.update(poolclass=QueuePool, pool_size=config['DATABASE_POOL_SIZE'],
+                           max_overflow=config['DATABASE_MAX_OVERFLOW'])
+    elif profile == 'postgresql':
+        options = {
+            'pool_size': config['DATABASE_POOL_SIZE'],
+            'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+            'connect_args': {'options': '-c statement_timeout={} -c lock_timeout={}'.format(
+                config['DATABASE_STATEMENT_TIMEOUT'], config['DATABASE_LOCK_TIMEOUT'])},
+        }
+    elif profile in ('default', 'mysql'):
+        options = {}
+    else:
+        raise ValueError('Unknown database profile: {}'.format(profile))
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    return options
+
+
+def set_sqlite_pragmas(engine, busy_timeout):
+    ''' lets readers and a writer work at the same time (WAL), waits for locks instead of
+    failing right away, and only syncs to disk at checkpoints '''
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(busy_timeout))
+        cursor.close()
+
+
+def configure_engine(app, db):
+    ''' sets up the new connections of the engine of the app for its profile '''
+    profile = app.config['DATABASE_PROFILE']
+    engine = db.get_engine(app)
+    if profile == 'sqlite' or profile == 'auto' and engine.url.get_backend_name() == 'sqlite':
+        set_sqlite_pragmas(engine, app.config['SQLITE_BUSY_TIMEOUT'])
@@ -0,0 +1,93 @@
+from flask import current_app
+from random import randrange
+from sqlalchemy import bindparam
+import threading
+
+
+class Deck(object):
+    ''' The cards of a game that are not guessed yet, for one round
+
+    The pile is an array of card ids: drawing swaps a random card with the last
+    one and pops it, returning a card appends it, both in constant time. Guessed
+    cards are kept in memory until the round ends and they are written at once. '''
+
+    def __init__(self, cards, round):
+        self.texts = dict(cards)
+        self.pile = list(self.texts)
+        self.round = round
+        # cards that were drawn and are neither returned nor guessed yet
+        self.drawn = set()
+        self.guessed = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pile)
+
+    def draw(self):
+        ''' removes a random card from the pile and returns (id, text), None when it is empty '''
+        with self.lock:
+            if not self.pile:
+                return
+            i = randrange(len(self.pile))
+            self.pile[i], self.pile[-1] = self.pile[-1], self.pile[i]
+            card_id = self.pile.pop()
+            self.drawn.add(card_id)
+        return card_id, self.texts[card_id]
+
+    def put_back(self, card_id):
+        ''' returns a drawn card that was not guessed to the pile '''
+        with self.lock:
+            if card_id in self.drawn:
+                self.drawn.remove(card_id)
+                self.pile.append(card_id)
+
+    def guess(self, card_id, user_id):
+        ''' records that a drawn card was guessed, returns whether it was drawn '''
+        with self.lock:
+            if card_id not in self.drawn:
+                return False
+            self.drawn.remove(card_id)
+            self.guessed[card_id] = user_id
+            return True
+
+
+class Decks(object):
+    ''' Flask extension that keeps the deck of every running round in memory
+
+    A deck lives in the process that started the round, so the players of a game
+    should be served by the same worker while a round runs. '''
+
+    def init_app(self, app):
+        app.extensions['decks'] = {}
+
+    @property
+    def decks(self):
+        return current_app.extensions['decks']
+
+    def deal(self, game):
+        ''' shuffles the cards that are not guessed yet into a new deck for the current round '''
+        from app.models import Card
+        cards = game.cards.filter(Card.guessed_round.is_(None)).with_entities(Card.id, Card.text)
+        deck = self.decks[game.id] = Deck(cards, game.current_round)
+        return deck
+
+    def get(self, game_id):
+        ''' returns the deck of the running round of the game, None if there is none '''
+        return self.decks.get(game_id)
+
+    def collect(self, game_id):
+        ''' removes the deck of the game and writes its guessed cards in one statement
+        in the current transaction, returns how many '''
+        from app import db
+        from app.models import Card
+        deck = self.decks.pop(game_id, None)
+        if deck is None:
+            return 0
+        with deck.lock:
+            rows = [{'card_id': id, 'guessed_by_id': user_id} for id, user_id in deck.guessed.items()]
+        if rows:
+            # a card is guessed once, also when two workers write it
+            db.session.execute(Card.__table__.update().where(
+                (Card.id == bindparam('card_id')) & Card.guessed_round.is_(None)).values(
+                guessed_round=deck.round, guessed_by=bindparam('guessed_by_id')), rows)
+        return len(rows)
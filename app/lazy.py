@@ -0,0 +1,60 @@
+from flask import current_app
+from importlib import import_module
+import sys
+
+
+class LazyImport(object):
+    ''' Stands in for an attribute of a module that is slow to import, and imports it
+    when it is first used '''
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._target = None
+
+    @property
+    def target(self):
+        if self._target is None:
+            self._target = getattr(import_module(self._module), self._name)
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def __call__(self, *args, **kwargs):
+        return self.target(*args, **kwargs)
+
+
+class LazyExtension(LazyImport):
+    ''' Stands in for a Flask extension that is slow to import. It is imported and
+    initialised for an app when it is first used in that app
+
+    Only for extensions whose init_app keeps state in app.extensions, and does not
+    register blueprints, templates or hooks, which Flask wants before the first request. '''
+
+    def __init__(self, module, name, key):
+        super().__init__(module, name)
+        self._key = key
+
+    @property
+    def target(self):
+        if self._target is None:
+            self._target = getattr(import_module(self._module), self._name)()
+        return self._target
+
+    def init_app(self, app, *args, **kwargs):
+        app.extensions['lazy_' + self._key] = (args, kwargs)
+        if self._module in sys.modules:
+            # already paid for, e.g. by the flask command that loaded its commands
+            self.load(app)
+
+    def load(self, app):
+        ''' initialises the extension for the app if it was not yet, and returns it '''
+        pending = app.extensions.pop('lazy_' + self._key, None)
+        if pending is not None:
+            args, kwargs = pending
+            self.target.init_app(app, *args, **kwargs)
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.load(current_app._get_current_object()), name)
@@ -0,0 +1,214 @@
+from flask import g, request, has_request_context
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from time import perf_counter, monotonic
+from uuid import uuid4
+import threading
+import logging
+import atexit
+import queue
+import copy
+import json
+import os
+
+
+class JSONFormatter(logging.Formatter):
+    ''' formats records as one JSON object per line '''
+
+    FIELDS = ('request_id', 'method', 'path', 'endpoint', 'duration')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class RequestQueueHandler(QueueHandler):
+    ''' puts records on the queue with the request they were logged in, so the handlers
+    that write them run in the listener thread, out of the request '''
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+            record.endpoint = request.endpoint
+            start = g.get('request_start')
+            if start is not None:
+                record.duration = round(perf_counter() - start, 6)
+        return record
+
+
+class BatchingSMTPHandler(SMTPHandler):
+    ''' mails records in batches, at most one mail per interval (in seconds) with at most
+    capacity records; the first record after a quiet interval is mailed right away '''
+
+    def __init__(self, *args, interval=300, capacity=50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.capacity = capacity
+        self.records = []
+        self.dropped = 0
+        self.sent = None
+        self.timer = None
+
+    def emit(self, record):
+        with self.lock:
+            if len(self.records) < self.capacity:
+                self.records.append(record)
+            else:
+                self.dropped += 1
+            wait = 0 if self.sent is None else self.sent + self.interval - monotonic()
+            if wait <= 0:
+                self._send()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            self._send()
+
+    def _send(self):
+        records, dropped = self.records, self.dropped
+        self.records, self.dropped = [], 0
+        if not records:
+            return
+        self.sent = monotonic()
+        try:
+            import smtplib
+            from email.message import EmailMessage
+            import email.utils
+
+            body = '\n\n'.join(self.format(r) for r in records)
+            if dropped:
+                body += '\n\n... and {} more'.format(dropped)
+            msg = EmailMessage()
+            msg['From'] = self.fromaddr
+            msg['To'] = ','.join(self.toaddrs)
+            msg['Subject'] = '{} ({} errors)'.format(self.subject, len(records) + dropped)
+            msg['Date'] = email.utils.localtime()
+            msg.set_content(body)
+            smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT, timeout=self.timeout)
+            if self.username:
+                if self.secure is not None:
+                    smtp.ehlo()
+                    smtp.starttls(*self.secure)
+                    smtp.ehlo()
+                smtp.login(self.username, self.password)
+            smtp.send_message(msg)
+            smtp.quit()
+        except Exception:
+            self.handleError(records[-1])
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._send()
+        super().close()
+
+
+class LogPipeline(object):
+    ''' Flask extension that gives every request an id, and outside debug and testing
+    writes the log records of the app as JSON lines to a rotating file and mails errors
+    in batches, from a listener thread so requests never wait for log I/O '''
+
+    def init_app(self, app):
+        app.config.setdefault('LOG_DIR', 'logs')
+        app.config.setdefault('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024)
+        app.config.setdefault('LOG_FILE_BACKUPS', 10)
+        app.config.setdefault('LOG_MAIL_INTERVAL', 300)
+        app.config.setdefault('LOG_MAIL_CAPACITY', 50)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if not app.debug and not app.testing:
+            self.start(app)
+
+    @staticmethod
+    def _before_request():
+        # keep the id of a proxy in front of the app, so its logs can be matched
+        g.request_id = request.headers.get('X-Request-ID') or uuid4().hex
+        g.request_start = perf_counter()
+
+    @staticmethod
+    def _after_request(response):
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        return response
+
+    def start(self, app):
+        ''' starts the listener thread and sends the log records of the app to it '''
+        handlers = []
+
+        # Email logging
+        if app.config['MAIL_SERVER']:
+            auth = None
+            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+            secure = None
+            if app.config['MAIL_USE_TLS']:
+                secure = ()
+            mail_handler = BatchingSMTPHandler(
+                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+                toaddrs=app.config['ADMINS'], subject='WitM error notification',
+                credentials=auth, secure=secure,
+                interval=app.config['LOG_MAIL_INTERVAL'], capacity=app.config['LOG_MAIL_CAPACITY'])
+            mail_handler.setFormatter(JSONFormatter())
+            mail_handler.setLevel(logging.ERROR)
+            handlers.append(mail_handler)
+
+        # File logging
+        os.makedirs(app.config['LOG_DIR'], exist_ok=True)
+        file_handler = RotatingFileHandler(
+            os.path.join(app.config['LOG_DIR'], 'who-is-the-man.log'),
+            maxBytes=app.config['LOG_FILE_MAX_BYTES'], backupCount=app.config['LOG_FILE_BACKUPS'])
+        file_handler.setFormatter(JSONFormatter())
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+        records = queue.Queue()
+        listener = QueueListener(records, *handlers, respect_handler_level=True)
+        queue_handler = RequestQueueHandler(records)
+        app.extensions['log_pipeline'] = (listener, queue_handler)
+        listener.start()
+        # write out the records still on the queue when the process exits
+        atexit.register(self.stop, app)
+
+        app.logger.addHandler(queue_handler)
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('App started up')
+
+    def stop(self, app):
+        ''' writes out the queued records, mails the pending errors and stops the listener '''
+        pipeline = app.extensions.pop('log_pipeline', None)
+        if pipeline is None:
+            return
+        listener, queue_handler = pipeline
+        app.logger.removeHandler(queue_handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
@@ -0,0 +1,115 @@
+from app import db, socketio, broker, presence, decks
+from app.broker import events_published
+from flask import current_app
+from flask_login import current_user
+from flask_socketio import join_room
+import json
+
+NAMESPACE = '/game'
+
+# events that players send during a round, and whether only the host may send them
+CLIENT_EVENTS = {
+    'cards_submitted': False,
+    'guess': False,
+    'turn_started': True,
+    'turn_stopped': True,
+    'score_updated': True,
+}
+
+
+def room(channel, channel_id):
+    return '{}-{}'.format(channel, channel_id)
+
+
+def to_message(event):
+    return json.loads(event.to_json())
+
+
+@socketio.on('connect', namespace=NAMESPACE)
+def connect():
+    ''' joins the rooms of the user and the game, using the Flask-Login session '''
+    if not current_user.is_authenticated:
+        return False
+    join_room(room('user', current_user.id))
+    if current_user.game_id is not None:
+        join_room(room('game', current_user.game_id))
+    presence.touch(current_user.id)
+
+
+@socketio.on('sync', namespace=NAMESPACE)
+def sync(cursor):
+    ''' returns the notifications after the game and user sequence numbers of the client,
+    to catch up after (re)connecting '''
+    try:
+        user_since, game_since = (int(cursor.get(channel) or 0) for channel in ('user', 'game'))
+    except (AttributeError, TypeError, ValueError):
+        return {'error': 'invalid cursor'}
+    presence.touch(current_user.id)
+    notifications = broker.page(current_user.id, user_since, current_user.game_id, game_since,
+                                limit=current_app.config['NOTIFICATIONS_PAGE_SIZE'])
+    return [to_message(n) for n in notifications]
+
+
+@socketio.on('game_event', namespace=NAMESPACE)
+def game_event(message):
+    ''' sends an event of a player to everyone in the game, returns its sequence number '''
+    name = message.get('name') if isinstance(message, dict) else None
+    if current_user.game_id is None:
+        return {'error': 'not in a game'}
+    if name not in CLIENT_EVENTS:
+        return {'error': 'unknown event'}
+    if CLIENT_EVENTS[name] and not current_user.is_host():
+        return {'error': 'only the host can do that'}
+    data = message.get('data')
+    data = dict(data) if isinstance(data, dict) else {}
+    # stored with the notification and sent to every player
+    if len(json.dumps(data)) > current_app.config['GAME_EVENT_MAX_BYTES']:
+        return {'error': 'the event is too large'}
+    data['username'] = current_user.username
+    presence.touch(current_user.id)
+    notification = current_user.game.add_notification(name, data)
+    seq = notification.seq
+    db.session.commit()
+    # sharded notifications are numbered by the commit
+    return {'seq': notification.seq if seq is None else seq}
+
+
+@socketio.on('draw_card', namespace=NAMESPACE)
+def draw_card():
+    ''' draws a random card from the deck of the running round, for the player to explain '''
+    deck = decks.get(current_user.game_id)
+    if deck is None:
+        return {'error': 'no round is running'}
+    card = deck.draw()
+    if card is None:
+        return {'error': 'the pile is empty'}
+    return {'id': card[0], 'text': card[1]}
+
+
+@socketio.on('put_back', namespace=NAMESPACE)
+def put_back(card_id):
+    ''' returns a card that was not guessed to the pile '''
+    deck = decks.get(current_user.game_id)
+    if deck is not None:
+        deck.put_back(card_id)
+
+
+@socketio.on('card_guessed', namespace=NAMESPACE)
+def card_guessed(card_id):
+    ''' records that a drawn card was guessed and tells the game how many cards are left;
+    the card is written to the database when the round ends '''
+    deck = decks.get(current_user.game_id)
+    if deck is None or not deck.guess(card_id, current_user.id):
+        return {'error': 'the card was not drawn'}
+    notification = current_user.game.add_notification('card_guessed', {
+        'username': current_user.username, 'cards_left': len(deck)})
+    seq = notification.seq
+    db.session.commit()
+    return {'seq': notification.seq if seq is None else seq}
+
+
+@events_published.connect
+def push_events(app, events):
+    ''' pushes committed notifications to the sockets in their room '''
+    for e in events:
+        socketio.emit('notification', to_message(e), room=room(e.channel, e.channel_id), namespace=NAMESPACE)
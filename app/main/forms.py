@@ -1,19 +1,19 @@
 from flask_wtf import FlaskForm
 from flask import current_app
-from wtforms import StringField, TextAreaField, PasswordField, BooleanField, SubmitField, IntegerField
-from wtforms.validators import DataRequired, NumberRange
+from wtforms import StringField, TextAreaField, PasswordField, BooleanField, SubmitField, IntegerField, FieldList
+from wtforms.validators import DataRequired, NumberRange, Length
 from flask_babel import _, lazy_gettext as _l
 
 class SettingsForm(FlaskForm):
 
-    num_rounds = IntegerField(label=_l('Number of cards'), default=3, description=_l('How many cards does each player write?'),
-                              validators=[DataRequired(), NumberRange(min=1, max=10)])
+    num_cards = IntegerField(label=_l('Number of cards'), default=3, description=_l('How many cards does each player write?'),
+                             validators=[DataRequired(), NumberRange(min=1, max=10)])
 
     round_time = IntegerField(label=_l('Duration of rounds'), default=30,
                              description=_l('How many seconds does each round take?'), validators=[DataRequired(), NumberRange(min=10, max=120)])
 
-    num_cards = IntegerField(label=_l('Number of rounds'), default=3,
-                             description=_l('How many rounds do you want to play?'), validators=[DataRequired(), NumberRange(min=1, max=20)])
+    num_rounds = IntegerField(label=_l('Number of rounds'), default=3,
+                              description=_l('How many rounds do you want to play?'), validators=[DataRequired(), NumberRange(min=1, max=20)])
 
 
     submit = SubmitField(_l("Next"))
@@ -21,5 +21,17 @@ class SettingsForm(FlaskForm):
 
 class SelectTeamsForm(FlaskForm):
 
-    # empty form - fields are added in route 
+    num_teams = IntegerField(label=_l('Number of teams'), default=2,
+                             validators=[DataRequired(), NumberRange(min=2, max=10)])
+
+    keep_apart = TextAreaField(label=_l('Keep apart'),
+                               description=_l('Players who should not be in the same team, one pair per line, e.g. "Alice, Bob"'))
+
     submit = SubmitField(_l('Start game!'))
+
+
+class CardsForm(FlaskForm):
+
+    # one entry per card, the number of cards is added in route
+    cards = FieldList(StringField(_l('Card'), validators=[DataRequired(), Length(max=128)]))
+    submit = SubmitField(_l('Done'))
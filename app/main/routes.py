@@ -1,24 +1,93 @@
 from app.main import bp
-from app import db
-from flask import render_template, request, jsonify, redirect, url_for, current_app, flash
+from app import db, broker, presence, rounds
+from flask import render_template, request, redirect, url_for, current_app, flash, \
+    Response, stream_with_context, jsonify
 from flask_login import login_required, current_user
-from wtforms import TextField
-from app.models import Notification, Setting
-from app.main.forms import SettingsForm, SelectTeamsForm
+from app.models import User, Setting, Card
+from app.teams import assign_teams, save_teams
+from app.main.forms import SettingsForm, SelectTeamsForm, CardsForm
 from flask_babel import _
+from time import time
+import re
 
 @bp.route('/notifications')
 @login_required
 def notifications():
-    ''' retrieves notifications for current users as JSON '''
-    since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    ''' retrieves notifications for current users as JSON
+
+    The client passes the last sequence number it has seen of its own channel
+    (user_since) and of the game channel (game_since). When there is nothing newer the
+    answer is an empty list with an ETag of the last sequence numbers, which clients send
+    back in If-None-Match to get a 304 instead. '''
+    presence.touch(current_user.id)
+    user_id, game_id = current_user.id, current_user.game_id
+    user_since = request.args.get('user_since', 0, type=int)
+    game_since = request.args.get('game_since', 0, type=int)
+
+    user_head = broker.head('user', user_id)
+    game_head = broker.head('game', game_id) if game_id is not None else 0
+    if user_head <= user_since and game_head <= game_since:
+        # nothing new, so answer without reading the notifications
+        response = Response('[]', mimetype='application/json')
+        response.set_etag('{}-{}-{}'.format(game_id or 0, game_head, user_head))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    notifications = broker.page(user_id, user_since, game_id, game_since,
+                                limit=current_app.config['NOTIFICATIONS_PAGE_SIZE'])
+
+    # the payloads are stored as JSON already, so they are written out row by row as is
+    def generate():
+        yield '['
+        for i, n in enumerate(notifications):
+            yield (',' if i else '') + n.to_json()
+        yield ']'
+
+    return Response(generate(), mimetype='application/json')
+
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    ''' streams notifications for the current user as server-sent events
+
+    The connection is closed after NOTIFICATION_STREAM_TIMEOUT seconds, the
+    browser then reconnects and resumes from the Last-Event-ID header, which
+    holds the game and user sequence numbers as "<game_seq>-<user_seq>". '''
+    cursor = {
+        'game': request.args.get('game_since', 0, type=int),
+        'user': request.args.get('user_since', 0, type=int)
+    }
+    last_event_id = re.match(r'^(\d+)-(\d+)$', request.headers.get('Last-Event-ID', ''))
+    if last_event_id:
+        cursor['game'], cursor['user'] = map(int, last_event_id.groups())
+    user_id, game_id = current_user.id, current_user.game_id
+    interval = current_app.config['NOTIFICATION_STREAM_INTERVAL']
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    limit = current_app.config['NOTIFICATIONS_PAGE_SIZE']
+
+    def stream():
+        started = time()
+        yield 'retry: 1000\n\n'
+        while True:
+            presence.touch(user_id)
+            notifications = broker.page(user_id, cursor['user'], game_id, cursor['game'], limit=limit)
+            # release the connection if the database was needed to catch up
+            db.session.close()
+            for n in notifications:
+                cursor[n.channel] = n.seq
+                yield 'id: {}-{}\nevent: {}\ndata: {}\n\n'.format(
+                    cursor['game'], cursor['user'], n.name, n.payload_json)
+            if time() - started >= timeout:
+                break
+            if not notifications:
+                # comment line to keep proxies from closing the connection
+                yield ':\n\n'
+                broker.wait(user_id, cursor['user'], game_id, cursor['game'],
+                            timeout=min(interval, max(0, timeout - (time() - started))))
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @bp.route('/init_game', methods=['POST','GET'])
 @login_required
@@ -34,10 +103,8 @@ def init_game():
 
     # submit settings to db if form submitted
     if form.validate_on_submit():
-        # delete all existing settings
-        game.settings.delete()
-        for setting in ['num_cars','num_rounds','round_time']:
-            game.setting(key=setting, value=form[setting].data)
+        # replace all existing settings
+        game.update_settings({key: form[key].data for key in ['num_cards', 'num_rounds', 'round_time']})
         db.session.commit()
         flash(_('All set up - now select the teams and we\'re good to go!'))
         return redirect(url_for('main.select_teams'))
@@ -47,25 +114,79 @@ def init_game():
 @bp.route('/select_teams', methods=['POST','GET'])
 @login_required
 def select_teams():
-    ''' selects the teams '''
+    ''' divides the players over balanced teams '''
 
     # redirect back to lobby if the current user is not a host
     if not current_user.is_host():
         return redirect(url_for('auth.lobby'))
 
+    game = current_user.game
     form = SelectTeamsForm()
 
-    players = current_user.game.players.all()
-    for player in players:
-        setattr(form, 'player_' + str(player.id), TextField(player.username))
-
     if form.validate_on_submit():
-        pass
+        players = dict(game.players.with_entities(User.username, User.id))
+        apart = []
+        for line in form.keep_apart.data.splitlines():
+            names = [name.strip() for name in line.split(',') if name.strip()]
+            if not names:
+                continue
+            unknown = [name for name in names if name not in players]
+            if len(names) != 2 or unknown:
+                form.keep_apart.errors.append(_('Not a pair of players: %(line)s', line=line))
+                break
+            apart.append((players[names[0]], players[names[1]]))
+        else:
+            try:
+                teams = assign_teams(players.values(), form.num_teams.data, apart)
+            except ValueError:
+                form.keep_apart.errors.append(_('These players cannot be kept apart in %(num)d teams',
+                                                num=form.num_teams.data))
+            else:
+                save_teams(game, teams)
+                names = {id: name for name, id in players.items()}
+                game.add_notification('teams_selected', {names[id]: team for id, team in teams.items()})
+                db.session.commit()
+                return redirect(url_for('main.enter_cards'))
 
     return render_template('main/select_teams.html', title="Select teams", form=form)
 
 
-@bp.route('/enter_cards')
+@bp.route('/enter_cards', methods=['POST','GET'])
 @login_required
 def enter_cards():
-    return 'Entering cards...'
+    ''' lets the player write the cards for the game, before the first round '''
+    game = current_user.game
+    num_cards = game.setting('num_cards') if game else None
+    if not num_cards or game.current_round:
+        return redirect(url_for('auth.lobby'))
+
+    form = CardsForm()
+    if form.validate_on_submit() and len(form.cards.data) == num_cards:
+        # replace the cards of the player
+        game.cards.filter_by(user_id=current_user.id).delete()
+        db.session.bulk_insert_mappings(Card, [
+            {'game_id': game.id, 'user_id': current_user.id, 'text': text} for text in form.cards.data])
+        db.session.commit()
+        flash(_('Your cards are in!'))
+        return redirect(url_for('auth.lobby'))
+
+    if not form.is_submitted():
+        for card in game.cards.filter_by(user_id=current_user.id).order_by(Card.id):
+            form.cards.append_entry(card.text)
+    while len(form.cards) < num_cards:
+        form.cards.append_entry()
+    return render_template('main/enter_cards.html', form=form, title=_('Enter cards'))
+
+@bp.route('/start_round', methods=['POST'])
+@login_required
+def start_round():
+    ''' starts the next round, which the server ends after the round time '''
+    if not current_user.is_host():
+        return jsonify({'error': _('Only the host can start a round')}), 403
+    game = current_user.game
+    number = rounds.start_round(game)
+    if number is None:
+        return jsonify({'error': _('The round cannot be started')}), 409
+    ends_at = game.round_ends_at
+    db.session.commit()
+    return jsonify({'round': number, 'ends_at': ends_at})
@@ -0,0 +1,132 @@
+from collections import defaultdict
+from flask import current_app, g, request, has_app_context, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from time import perf_counter
+import threading
+
+# upper bounds of the buckets of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class _EndpointStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.handler_seconds = 0.0
+        self.response_bytes = 0
+        self.buckets = [0] * len(BUCKETS)
+
+
+class _Registry(object):
+
+    def __init__(self):
+        self.endpoints = defaultdict(_EndpointStats)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, queries, sql_seconds, handler_seconds, response_bytes):
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats.requests += 1
+            stats.queries += queries
+            stats.sql_seconds += sql_seconds
+            stats.handler_seconds += handler_seconds
+            stats.response_bytes += response_bytes
+            for i, bound in enumerate(BUCKETS):
+                if handler_seconds <= bound:
+                    stats.buckets[i] += 1
+
+
+class Metrics(object):
+    ''' Flask extension that records the number of queries, SQL time, handler time and
+    response size per endpoint and exports them in the Prometheus text format '''
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('SLOW_REQUEST_THRESHOLD', None)
+        app.extensions['metrics'] = _Registry()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    @staticmethod
+    def _before_request():
+        g.request_metrics = {'start': perf_counter(), 'queries': 0, 'sql_seconds': 0.0}
+
+    @staticmethod
+    def _after_request(response):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return response
+        handler_seconds = perf_counter() - metrics['start']
+        endpoint = request.endpoint or 'none'
+        # streamed responses have no length yet
+        size = response.calculate_content_length() or 0
+        current_app.extensions['metrics'].record(
+            endpoint, metrics['queries'], metrics['sql_seconds'], handler_seconds, size)
+
+        threshold = current_app.config['SLOW_REQUEST_THRESHOLD']
+        if threshold is not None and handler_seconds >= threshold:
+            current_app.logger.warning(
+                'Slow request %s %s (%s): %.3f s, %d queries, %.3f s SQL, %d bytes',
+                request.method, request.path, endpoint, handler_seconds,
+                metrics['queries'], metrics['sql_seconds'], size)
+        return response
+
+    def view(self):
+        ''' returns the metrics in the Prometheus text format '''
+        token = current_app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != 'Bearer ' + token:
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        registry = current_app.extensions['metrics']
+        with registry.lock:
+            endpoints = sorted(registry.endpoints.items())
+            lines = []
+            for name, kind, help, attribute in (
+                    ('witm_requests_total', 'counter', 'Requests handled', 'requests'),
+                    ('witm_sql_queries_total', 'counter', 'SQL statements executed', 'queries'),
+                    ('witm_sql_seconds_total', 'counter', 'Time spent executing SQL', 'sql_seconds'),
+                    ('witm_handler_seconds_total', 'counter', 'Time spent in request handlers', 'handler_seconds'),
+                    ('witm_response_bytes_total', 'counter', 'Size of the response bodies', 'response_bytes')):
+                lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+                for endpoint, stats in endpoints:
+                    lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, getattr(stats, attribute)))
+
+            lines += ['# HELP witm_request_duration_seconds Duration of request handlers',
+                      '# TYPE witm_request_duration_seconds histogram']
+            for endpoint, stats in endpoints:
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    lines.append('witm_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        endpoint, bound, count))
+                lines.append('witm_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'.format(
+                    endpoint, stats.requests))
+                lines.append('witm_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(
+                    endpoint, stats.handler_seconds))
+                lines.append('witm_request_duration_seconds_count{{endpoint="{}"}} {}'.format(
+                    endpoint, stats.requests))
+
+        caches = sorted(current_app.extensions.get('caches', {}).items())
+        for name, attribute in (('witm_cache_hits_total', 'hits'), ('witm_cache_misses_total', 'misses')):
+            lines += ['# TYPE {} counter'.format(name)]
+            for cache, instance in caches:
+                lines.append('{}{{cache="{}"}} {}'.format(name, cache, getattr(instance, attribute)))
+        return '\n'.join(lines) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    metrics = g.get('request_metrics') if has_app_context() else None
+    if metrics is not None:
+        metrics['queries'] += 1
+        metrics['sql_seconds'] += perf_counter() - start
@@ -1,15 +1,63 @@
 from app import db
 from flask_login import UserMixin
-from app import login
+from app import login, broker, notification_shards
+from app.broker import Event
+from app.cache import app_cache, TTLCache
+from sqlalchemy.orm import make_transient_to_detached
+from flask_sqlalchemy import SignallingSession
 from hashlib import md5
 from datetime import datetime
 from time import time
 import jwt
-from flask import current_app
+from flask import current_app, has_request_context, session as flask_session
 import json
+from heapq import merge
 
-class User(UserMixin, db.Model):
+def attach(model, **columns):
+    ''' returns the instance with the given primary key from the session, or attaches a
+    stand-in with the given columns; other columns are loaded when they are used '''
+    key = db.inspect(model).identity_key_from_primary_key((columns['id'],))
+    instance = db.session.identity_map.get(key)
+    if instance is None:
+        instance = model(**columns)
+        make_transient_to_detached(instance)
+        db.session.add(instance)
+    return instance
+
+class NotificationChannel(object):
+    ''' Mixin for models that notifications can be sent to '''
+
+    # sequence number of the last notification sent to this channel
+    last_seq = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+
+    def next_seq(self):
+        ''' increments the sequence number in the database and returns the new value
+
+        With notification shards the number is kept in the shard of the channel and taken
+        when the session is committed, and None is returned. '''
+        db.session.add(self)
+        if self.id is None:
+            db.session.flush()
+        if notification_shards.enabled:
+            return None
+        # incrementing in SQL locks the row, so concurrent writers get distinct numbers
+        self.last_seq = type(self).last_seq + 1
+        db.session.flush()
+        return self.last_seq
+
+    @property
+    def sent_seq(self):
+        ''' the sequence number of the last notification sent to this channel '''
+        if notification_shards.enabled:
+            return notification_shards.channel_seq(self.CHANNEL, self.id)
+        return self.last_seq
+
+class User(UserMixin, NotificationChannel, db.Model):
     ''' User model '''
+
+    # columns that are cached to identify the user of a request
+    CACHED_COLUMNS = ('id', 'username', 'game_id', 'role', 'team')
+    CHANNEL = 'user'
     id = db.Column(db.Integer, primary_key = True)
 
     # User Name
@@ -28,6 +76,9 @@ class User(UserMixin, db.Model):
                                     backref='user',
                                     lazy='dynamic')
 
+    # names are unique within a game, users without a game (NULL) can share them
+    __table_args__ = (db.Index('ix_user_game_id_username', 'game_id', 'username', unique=True),)
+
     def avatar(self, size=128):
         ''' Returns URL for Gravatar '''
         digest = md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -35,8 +86,9 @@ class User(UserMixin, db.Model):
 
     def add_notification(self, name, data):
         #self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
+        seq = self.next_seq()
+        n = Notification(name=name, payload_json=json.dumps(data), user_id=self.id, seq=seq)
+        n.publish()
         return n
 
     def is_host(self):
@@ -45,11 +97,12 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
-class Game(db.Model):
+class Game(NotificationChannel, db.Model):
 
+    CHANNEL = 'game'
     id = db.Column(db.Integer, primary_key=True)
 
-    name = db.Column(db.String(128), index=True)
+    name = db.Column(db.String(128), index=True, unique=True)
 
     created = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -57,37 +110,120 @@ class Game(db.Model):
 
     settings = db.relationship('Setting', backref='game', lazy='dynamic')
 
+    cards = db.relationship('Card', backref='game', lazy='dynamic')
+
+    # incremented whenever the settings change, to invalidate cached settings
+    settings_version = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+
+    # incremented whenever a player joins or the host changes, to invalidate the cached lobby
+    players_version = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+
+    notifications = db.relationship('Notification',
+                                    backref='game',
+                                    lazy='dynamic')
+
+    # the round being played, and while it runs when it ends (as a unix timestamp)
+    current_round = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    round_ends_at = db.Column(db.Float, index=True)
+
+    def add_notification(self, name, data):
+        ''' adds a single notification that is read by all players of the game '''
+        seq = self.next_seq()
+        n = Notification(name=name, payload_json=json.dumps(data), game_id=self.id, seq=seq)
+        n.publish()
+        return n
+
     def set_host(self, user):
         ''' adds a host to the game '''
         if not user in self.players:
             self.players.append(user)
         user.role = current_app.config['ROLES']['HOST']
         db.session.add(user)
+        self.players_changed()
+
+    def players_changed(self):
+        ''' invalidates the cached player list of the lobby '''
+        # a new game has nothing cached yet
+        if self.id is not None:
+            self.players_version = Game.players_version + 1
 
     def get_host(self):
         ''' returns the host '''
-        for u in self.players:
-            if u.role == current_app.config['ROLES']['HOST']:
-                return u
+        return self.players.filter_by(role=current_app.config['ROLES']['HOST']).first()
+
+    def get_join_token(self, expires_in=600, epoch=None):
+        ''' returns a token to join the game, valid for expires_in seconds
 
-    def get_join_token(self, expires_in=600):
+        Tokens for the same epoch (see token_epoch) are identical, so pages and
+        images that contain them can be cached until the epoch ends. '''
+        if epoch is None:
+            exp = time() + expires_in
+        else:
+            exp = (epoch + 1) * current_app.config['JOIN_TOKEN_EPOCH'] + expires_in
         return jwt.encode(
-            {'join_game': self.id, 'exp': time() + expires_in},
+            {'join_game': self.id, 'exp': exp},
             current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
 
+    @staticmethod
+    def token_epoch():
+        ''' returns the number of the current time bucket for join tokens '''
+        return int(time() // current_app.config['JOIN_TOKEN_EPOCH'])
+
     @staticmethod
     def verify_join_token(token):
-        try:
-            id = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])['join_game']
-        except:
+        ''' returns the game of a join token, or None if the token is invalid or expired
+
+        Verified tokens are cached until they expire, so a burst of players joining
+        through the same link neither decodes the token nor queries the game again. '''
+        cache = app_cache('join_tokens', current_app.config['JOIN_TOKEN_CACHE_SIZE'], TTLCache,
+                          ttl=current_app.config['JOIN_TOKEN_CACHE_TTL'])
+        cached = cache.get(token)
+        if cached is None:
+            try:
+                payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+                id = int(payload['join_game'])
+            except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+                cache.set(token, False)
+                return
+            # database errors are raised, so a game is not taken for missing while they last
+            game = Game.query.get(id)
+            if game is None:
+                cache.set(token, False)
+                return
+            cache.set(token, (game.id, game.name), ttl=payload['exp'] - time())
+            return game
+        if not cached:
             return
-        return Game.query.get(id)
+        # attach a stand-in for the game to the session without loading it again
+        id, name = cached
+        return attach(Game, id=id, name=name)
 
     def setting(self, key, value=None):
         if value is None:
-            return Setting.query.filter_by(game=self, key=key).first().value
+            return self.get_settings().get(key)
         s = Setting(game=self, key = key, value = value)
         db.session.add(s)
+        self.settings_version = Game.settings_version + 1
+        db.session.flush()
+
+    def get_settings(self):
+        ''' returns all settings as a dict of typed values, loaded with a single query and
+        cached until the settings change '''
+        cache = app_cache('settings')
+        key = (self.id, self.settings_version)
+        settings = cache.get(key)
+        if settings is None:
+            settings = {s.key: Setting.TYPES.get(s.key, str)(s.value) for s in self.settings}
+            cache.set(key, settings)
+        return dict(settings)
+
+    def update_settings(self, settings):
+        ''' replaces all settings with the given dict in bulk '''
+        self.settings.delete()
+        db.session.bulk_insert_mappings(Setting, [
+            {'game_id': self.id, 'key': key, 'value': str(value)} for key, value in settings.items()])
+        self.settings_version = Game.settings_version + 1
+        db.session.flush()
 
     def __repr__(self):
         return f'<Game {self.name}>'
@@ -101,20 +237,134 @@ class Setting(db.Model):
     key = db.Column(db.String(128))
     value = db.Column(db.String(128))
 
+    # types of the values, settings that are not listed are strings
+    TYPES = {'num_cards': int, 'num_rounds': int, 'round_time': int}
+
     def __repr__(self):
         return f'<Setting {self.key} for {self.game.name}>'
 
+class Card(db.Model):
+    ''' a name written by a player, for the other players to guess '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    text = db.Column(db.String(128))
+    # the round the card was guessed in and by whom, NULL while it is in the pile
+    guessed_round = db.Column(db.Integer)
+    guessed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+
+    __table_args__ = (db.Index('ix_card_game_id_guessed_round', 'game_id', 'guessed_round'),)
+
+    def __repr__(self):
+        return f'<Card {self.text}>'
+
 # User loader for Flask Login module
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    ''' loads the user of a session, from a short-lived cache if possible
+
+    The cache of each worker only hears of the changes made in that worker, so entries
+    are kept with the identity version of the session (see _forget_changed_users) and
+    a session that changed its user misses in every worker. '''
+    cache = user_cache()
+    version = flask_session.get('identity_version', 0)
+    cached = cache.get(int(id))
+    if cached is None or cached[0] != version:
+        user = User.query.get(int(id))
+        if user is not None:
+            cache.set(user.id, (version, {key: getattr(user, key) for key in User.CACHED_COLUMNS}))
+        return user
+    # attach a stand-in to the session without loading the user again
+    return attach(User, **cached[1])
+
+def user_cache():
+    ''' returns the cache of the identities of logged in users '''
+    return app_cache('users', current_app.config['USER_CACHE_SIZE'], TTLCache,
+                     ttl=current_app.config['USER_CACHE_TTL'])
+
+@db.event.listens_for(User, 'after_update')
+def _user_changed(mapper, connection, target):
+    ''' marks a user whose cached columns changed, to drop it from the cache after commit '''
+    state = db.inspect(target)
+    if any(state.attrs[key].history.has_changes() for key in User.CACHED_COLUMNS + ('game',)):
+        state.session.info.setdefault('changed_users', set()).add(target.id)
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def _forget_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        cache = user_cache()
+        for id in changed:
+            cache.delete(id)
+        # the session cookie tells the other workers that the user of this request changed
+        if has_request_context() and flask_session.get('_user_id') is not None \
+                and int(flask_session['_user_id']) in changed:
+            flask_session['identity_version'] = flask_session.get('identity_version', 0) + 1
 
 class Notification(db.Model):
+    ''' Notification for either a single user or all players of a game '''
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'), index=True)
+    # position in the channel (user or game) the notification was sent to
+    seq = db.Column(db.Integer)
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_notification_user_id_seq', 'user_id', 'seq'),
+        db.Index('ix_notification_game_id_seq', 'game_id', 'seq'),
+    )
+
+    @property
+    def channel(self):
+        return 'game' if self.game_id is not None else 'user'
+
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    def to_event(self):
+        return Event(self.channel, self.game_id if self.game_id is not None else self.user_id,
+                     self.seq, self.name, self.payload_json, self.timestamp)
+
+    def publish(self):
+        ''' stores the notification if notifications are durable and publishes it once committed '''
+        if self.timestamp is None:
+            self.timestamp = time()
+        if notification_shards.enabled:
+            # numbered in its shard when the session is committed
+            notification_shards.queue(db.session, self)
+            return
+        if current_app.config['NOTIFICATIONS_DURABLE']:
+            db.session.add(self)
+        broker.queue(db.session, self.to_event())
+
+    @staticmethod
+    def channel_page(channel, channel_id, since=0, limit=100):
+        ''' returns the notifications of a channel after since, at most limit '''
+        if notification_shards.enabled:
+            return notification_shards.channel_page(channel, channel_id, since, limit)
+        column = Notification.game_id if channel == 'game' else Notification.user_id
+        return Notification.query.filter(column == channel_id, Notification.seq > since).order_by(
+            Notification.seq.asc()).limit(limit).all()
+
+    @staticmethod
+    def channel_head(channel, channel_id):
+        ''' returns the last sequence number of the stored notifications of a channel '''
+        if notification_shards.enabled:
+            return notification_shards.channel_head(channel, channel_id)
+        column = Notification.game_id if channel == 'game' else Notification.user_id
+        return db.session.query(db.func.max(Notification.seq)).filter(column == channel_id).scalar() or 0
+
+    @staticmethod
+    def page(user_id, user_since=0, game_id=None, game_since=0, limit=100):
+        ''' returns the notifications of a user and of the game (s)he is playing after the given
+        sequence numbers, at most limit per channel '''
+        user_notifications = Notification.channel_page('user', user_id, user_since, limit)
+        if game_id is None:
+            return user_notifications
+        game_notifications = Notification.channel_page('game', game_id, game_since, limit)
+        # merging keeps each channel in sequence order
+        return list(merge(user_notifications, game_notifications, key=lambda n: n.timestamp))
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam
+from time import monotonic
+import threading
+
+
+class _PresenceTable(object):
+    ''' When users were last seen, waiting to be written to the database '''
+
+    def __init__(self):
+        self.seen = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.flushed = monotonic()
+
+
+class Presence(object):
+    ''' Flask extension that tracks when users were last seen in memory and
+    writes User.last_seen in periodic bulk updates '''
+
+    def init_app(self, app):
+        app.config.setdefault('PRESENCE_FLUSH_INTERVAL', 60)
+        app.config.setdefault('PRESENCE_TIMEOUT', 60)
+        app.extensions['presence'] = _PresenceTable()
+
+    @property
+    def table(self):
+        return current_app.extensions['presence']
+
+    def touch(self, user_id):
+        ''' records that the user is connected, and flushes the table when it is due '''
+        table = self.table
+        with table.lock:
+            table.seen[user_id] = datetime.utcnow()
+            table.dirty.add(user_id)
+            due = monotonic() - table.flushed >= current_app.config['PRESENCE_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+
+    def last_seen(self, user_id, default=None):
+        ''' returns when the user was last seen, default if not since the table was created '''
+        return self.table.seen.get(user_id, default)
+
+    def is_online(self, user_id, last_seen=None):
+        ''' returns whether the user was seen recently; last_seen is the value from the database '''
+        last_seen = self.last_seen(user_id, last_seen)
+        timeout = timedelta(seconds=current_app.config['PRESENCE_TIMEOUT'])
+        return last_seen is not None and datetime.utcnow() - last_seen < timeout
+
+    def flush(self):
+        ''' writes last_seen of all users seen since the last flush in one statement '''
+        from app import db
+        from app.models import User
+        table = self.table
+        with table.lock:
+            rows = [{'user_id': id, 'last_seen': table.seen[id]} for id in table.dirty]
+            table.dirty.clear()
+            table.flushed = monotonic()
+        if not rows:
+            return 0
+        # a separate connection, so the request's session is not committed
+        with db.engine.begin() as connection:
+            connection.execute(User.__table__.update().where(User.id == bindparam('user_id')).values(
+                last_seen=bindparam('last_seen')), rows)
+        return len(rows)
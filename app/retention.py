@@ -0,0 +1,56 @@
+from app import db, broker, notification_shards
+from app.models import Notification, User
+from time import time, perf_counter
+import threading
+
+
+def prune_notifications(max_age, batch_size=1000):
+    ''' deletes notifications older than max_age seconds and notifications of games
+    without players, batch_size rows per transaction
+
+    Returns the number of rows removed and the time it took in seconds. '''
+    started = perf_counter()
+    if notification_shards.enabled:
+        active_games = {id for id, in db.session.query(User.game_id).filter(User.game_id.isnot(None)).distinct()}
+        removed = notification_shards.prune(max_age, active_games, batch_size)
+        broker.backend.prune(max_age)
+        return removed, perf_counter() - started
+    cutoff = time() - max_age
+    abandoned = ~db.exists().where(User.game_id == Notification.game_id)
+    condition = db.or_(Notification.timestamp < cutoff,
+                       db.and_(Notification.game_id.isnot(None), abandoned))
+    removed = 0
+    while True:
+        # short transactions, so polls and joins are not blocked for long
+        ids = db.session.query(Notification.id).filter(condition).limit(batch_size).subquery()
+        count = Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += count
+        if count < batch_size:
+            break
+    broker.backend.prune(max_age)
+    return removed, perf_counter() - started
+
+
+def start_pruning(app):
+    ''' prunes notifications every NOTIFICATION_PRUNE_INTERVAL seconds in a background thread '''
+    interval = app.config['NOTIFICATION_PRUNE_INTERVAL']
+
+    def run():
+        with app.app_context():
+            try:
+                removed, seconds = prune_notifications(app.config['NOTIFICATION_RETENTION'],
+                                                       app.config['NOTIFICATION_PRUNE_BATCH_SIZE'])
+                app.logger.info('Pruned %d notifications in %.3f s', removed, seconds)
+            except Exception:
+                app.logger.exception('Pruning notifications failed')
+            finally:
+                db.session.remove()
+        schedule()
+
+    def schedule():
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+
+    schedule()
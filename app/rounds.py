@@ -0,0 +1,177 @@
+from flask import current_app
+from heapq import heappush, heappop, heapify
+from time import time
+import threading
+
+
+class Scheduler(object):
+    ''' Calls back with the key of every timer that is due, from a heap of deadlines
+    driven by a single thread '''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        # the deadline of the active timer per key, heap entries that differ are cancelled
+        self.timers = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline):
+        ''' sets the timer of key to deadline, replacing an earlier one '''
+        with self.condition:
+            self.timers[key] = deadline
+            heappush(self.heap, (deadline, key))
+            # keep cancelled entries from piling up
+            if len(self.heap) > 2 * len(self.timers) + 64:
+                self.heap = [(d, k) for d, k in self.heap if self.timers.get(k) == d]
+                heapify(self.heap)
+            if self.heap[0] == (deadline, key):
+                self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            self.timers.pop(key, None)
+
+    def pop_due(self, now=None):
+        ''' removes and returns the keys of the timers that are due, earliest first '''
+        now = time() if now is None else now
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heappop(self.heap)
+                if self.timers.get(key) == deadline:
+                    del self.timers[key]
+                    due.append(key)
+        return due
+
+    def next_deadline(self):
+        with self.condition:
+            while self.heap and self.timers.get(self.heap[0][1]) != self.heap[0][0]:
+                heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+    def run(self):
+        ''' fires the timers as they become due, forever '''
+        while True:
+            with self.condition:
+                deadline = self.next_deadline()
+                if deadline is None or deadline > time():
+                    self.condition.wait(None if deadline is None else deadline - time())
+                    continue
+            for key in self.pop_due():
+                self.callback(key)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='round-scheduler', daemon=True)
+        self.thread.start()
+
+
+class Rounds(object):
+    ''' Flask extension that runs the rounds of all games, ending them on time from
+    one scheduler per process '''
+
+    def init_app(self, app):
+        app.config.setdefault('ROUND_SCHEDULER', True)
+        app.config.setdefault('ROUND_RECOVERY_GRACE', 5)
+        app.extensions['rounds'] = Scheduler(lambda game_id: self._fire(app, game_id))
+
+    @property
+    def scheduler(self):
+        return current_app.extensions['rounds']
+
+    def start_round(self, game):
+        ''' starts the next round of the game with a new deck, returns its number or
+        None when all rounds were played or a round is running '''
+        from app import db, decks
+        from app.models import Game
+        settings = game.get_settings()
+        if game.round_ends_at is not None or game.current_round >= settings.get('num_rounds', 0):
+            return
+        ends_at = time() + settings['round_time']
+        # only one request can start the round
+        started = Game.query.filter_by(id=game.id, current_round=game.current_round, round_ends_at=None).update(
+            {'current_round': Game.current_round + 1, 'round_ends_at': ends_at}, synchronize_session=False)
+        if not started:
+            return
+        db.session.refresh(game)
+        decks.deal(game)
+        game.add_notification('round_started', {'round': game.current_round, 'ends_at': ends_at})
+        # a timer of a round that is not committed finds nothing to end
+        self.scheduler.schedule(game.id, ends_at)
+        return game.current_round
+
+    def end_round(self, game_id, now=None):
+        ''' ends the running round of the game if it is due and notifies the players,
+        returns whether it did; the conditional update lets only one worker end it
+
+        The cards guessed from the deck of the round are written in the same transaction. '''
+        from app import db, decks
+        from app.models import Game
+        now = time() if now is None else now
+        ended = Game.query.filter(Game.id == game_id, Game.round_ends_at <= now).update(
+            {'round_ends_at': None}, synchronize_session=False)
+        if not ended:
+            db.session.rollback()
+            self._collect_ended(game_id)
+            return False
+        guessed = decks.collect(game_id)
+        game = Game.query.get(game_id)
+        game.add_notification('round_ended', {
+            'guessed': guessed,
+            'round': game.current_round,
+            'last': game.current_round >= game.get_settings().get('num_rounds', 0)})
+        db.session.commit()
+        return True
+
+    def _collect_ended(self, game_id):
+        ''' writes the guessed cards of the deck here when another worker ended its round '''
+        from app import db, decks
+        from app.models import Game
+        deck = decks.get(game_id)
+        if deck is None:
+            return
+        current_round, ends_at = db.session.query(Game.current_round, Game.round_ends_at).filter(
+            Game.id == game_id).first() or (None, None)
+        if current_round == deck.round and ends_at is not None:
+            # still running
+            return
+        decks.collect(game_id)
+        db.session.commit()
+
+    def recover(self):
+        ''' schedules the running rounds from the database, after a restart
+
+        The rounds may be running in other workers, so they are ended ROUND_RECOVERY_GRACE
+        seconds late, after the worker with the deck has ended them with its guesses. '''
+        from app.models import Game
+        grace = current_app.config['ROUND_RECOVERY_GRACE']
+        running = Game.query.with_entities(Game.id, Game.round_ends_at).filter(Game.round_ends_at.isnot(None)).all()
+        for game_id, ends_at in running:
+            self.scheduler.schedule(game_id, ends_at + grace)
+        return len(running)
+
+    def _fire(self, app, game_id):
+        from app import db
+        with app.app_context():
+            try:
+                self.end_round(game_id)
+            except Exception:
+                app.logger.exception('Ending the round of game %d failed', game_id)
+                db.session.rollback()
+
+
+def start_scheduler(app):
+    ''' picks up the running rounds and starts the scheduler thread '''
+    from app import db, rounds
+    with app.app_context():
+        try:
+            app.logger.info('Recovered %d running rounds', rounds.recover())
+        except Exception:
+            # e.g. before the database is upgraded
+            app.logger.exception('Recovering running rounds failed')
+        finally:
+            db.session.remove()
+    app.extensions['rounds'].start()
@@ -0,0 +1,44 @@
+from gunicorn.app.base import BaseApplication
+
+
+class Server(BaseApplication):
+    ''' Serves the app with gunicorn's threaded worker, which hands the raw socket to
+    simple-websocket, so Socket.IO clients upgrade to a WebSocket; the Werkzeug server
+    of flask run only offers them long polling
+
+    There is a single worker, the decks of the running rounds live in its memory. '''
+
+    def __init__(self, app, bind='127.0.0.1:5000', threads=100):
+        self.app = app
+        self.options = {
+            'bind': bind,
+            'workers': 1,
+            'worker_class': 'gthread',
+            'threads': threads,
+            'post_fork': self.post_fork,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+    def post_fork(self, server, worker):
+        ''' the worker does not inherit the threads and connections of the app '''
+        from app import db, log_pipeline
+        with self.app.app_context():
+            db.engine.dispose()
+        shards = self.app.extensions.get('notification_shards')
+        for engine in shards.engines if shards else ():
+            engine.dispose()
+        if 'log_pipeline' in self.app.extensions:
+            log_pipeline.stop(self.app)
+            log_pipeline.start(self.app)
+
+
+def serve(app, bind='127.0.0.1:5000', threads=100):
+    ''' serves the app and its Socket.IO connections until interrupted '''
+    Server(app, bind, threads).run()
@@ -0,0 +1,221 @@
+from app.database import engine_options, set_sqlite_pragmas
+from collections import defaultdict
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, func, select, MetaData, Table, Column, Integer, String
+from time import time
+
+# the sequence number of the last notification of every channel in a shard
+channels = Table('notification_channel', MetaData(),
+                 Column('channel', String(8), primary_key=True),
+                 Column('channel_id', Integer, primary_key=True),
+                 Column('last_seq', Integer, nullable=False))
+
+
+class _Shards(object):
+
+    def __init__(self, engines):
+        self.engines = engines
+
+    def engine(self, channel_id):
+        return self.engines[channel_id % len(self.engines)]
+
+
+class NotificationShards(object):
+    ''' Flask extension that stores notifications in NOTIFICATION_SHARDS databases instead
+    of the main one, picked by the id of their channel, so all notifications of a game
+    are in one shard and busy games do not share a write lock
+
+    The sequence number of a channel is kept in its shard as well, so sending a
+    notification only writes to that shard. When the session is committed the
+    notifications are numbered and inserted in their shards, before the main transaction
+    is committed, and the shard transactions are committed or rolled back with it.
+
+    Users, games, settings and cards stay in the main database. '''
+
+    def init_app(self, app):
+        app.config.setdefault('NOTIFICATION_SHARDS', 0)
+        count = app.config['NOTIFICATION_SHARDS']
+        if not count:
+            app.extensions['notification_shards'] = None
+            return
+        from app.models import Notification
+        engines = []
+        for i in range(count):
+            url = app.config['NOTIFICATION_SHARD_URL'].format(i)
+            engine = create_engine(url, **engine_options(
+                dict(app.config, SQLALCHEMY_DATABASE_URI=url, SQLALCHEMY_ENGINE_OPTIONS=None)))
+            if engine.url.get_backend_name() == 'sqlite':
+                set_sqlite_pragmas(engine, app.config['SQLITE_BUSY_TIMEOUT'])
+            Notification.__table__.create(engine, checkfirst=True)
+            channels.create(engine, checkfirst=True)
+            engines.append(engine)
+        app.extensions['notification_shards'] = _Shards(engines)
+
+    @property
+    def shards(self):
+        return current_app.extensions['notification_shards']
+
+    @property
+    def enabled(self):
+        return self.shards is not None
+
+    def queue(self, session, notification):
+        ''' numbers, stores and publishes the notification when the session is committed '''
+        session.info.setdefault('sharded_notifications', []).append(notification)
+
+    def prepare(self, notifications, durable=True):
+        ''' numbers the notifications and, if durable, inserts them in their shards without
+        committing, returns the shard transactions; when a statement fails they are rolled
+        back and it is raised '''
+        from app.models import Notification
+        by_engine = defaultdict(list)
+        for n in notifications:
+            by_engine[self.shards.engine(n.to_event().channel_id)].append(n)
+        transactions = []
+        try:
+            # always in the order of the shards, so two sessions never wait on each other
+            for engine in sorted(by_engine, key=self.shards.engines.index):
+                connection = engine.connect()
+                transactions.append(connection.begin())
+                self._number(connection, by_engine[engine])
+                if durable:
+                    connection.execute(Notification.__table__.insert(), [{
+                        'name': n.name, 'user_id': n.user_id, 'game_id': n.game_id, 'seq': n.seq,
+                        'timestamp': n.timestamp, 'payload_json': n.payload_json} for n in by_engine[engine]])
+        except Exception:
+            self.finish(transactions, commit=False)
+            raise
+        return transactions
+
+    def _number(self, connection, notifications):
+        ''' gives the notifications the next sequence numbers of their channels '''
+        by_channel = defaultdict(list)
+        for n in notifications:
+            by_channel[(n.channel, n.to_event().channel_id)].append(n)
+        for (channel, channel_id), sent in by_channel.items():
+            key = (channels.c.channel == channel) & (channels.c.channel_id == channel_id)
+            # incrementing in SQL locks the shard, so concurrent writers get distinct numbers
+            if not connection.execute(channels.update().where(key).values(
+                    last_seq=channels.c.last_seq + len(sent))).rowcount:
+                # the first notification of the channel in this shard
+                head = self._stored_head(connection, channel, channel_id)
+                connection.execute(channels.insert().values(
+                    channel=channel, channel_id=channel_id, last_seq=head + len(sent)))
+            last_seq = connection.execute(select([channels.c.last_seq]).where(key)).scalar()
+            for seq, n in enumerate(sent, last_seq - len(sent) + 1):
+                n.seq = seq
+
+    @staticmethod
+    def _stored_head(connection, channel, channel_id):
+        from app.models import Notification
+        table = Notification.__table__
+        column = table.c.game_id if channel == 'game' else table.c.user_id
+        return connection.execute(select([func.max(table.c.seq)]).where(column == channel_id)).scalar() or 0
+
+    def finish(self, transactions, commit):
+        ''' commits or rolls back the shard transactions of prepare '''
+        for transaction in transactions:
+            try:
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+            except Exception:
+                # the main transaction is already decided, so do not fail the request for it
+                current_app.logger.exception('Could not finish a notification shard transaction')
+            finally:
+                transaction.connection.close()
+
+    def channel_page(self, channel, channel_id, since=0, limit=100):
+        ''' returns the notifications of a channel after since, at most limit '''
+        from app.models import Notification
+        table = Notification.__table__
+        column = table.c.game_id if channel == 'game' else table.c.user_id
+        with self.shards.engine(channel_id).connect() as connection:
+            rows = connection.execute(select([table]).where(
+                (column == channel_id) & (table.c.seq > since)).order_by(table.c.seq).limit(limit)).fetchall()
+        # transient instances, they are not in the main database
+        return [Notification(**dict(row)) for row in rows]
+
+    def channel_head(self, channel, channel_id):
+        ''' returns the last sequence number of the stored notifications of a channel '''
+        with self.shards.engine(channel_id).connect() as connection:
+            return self._stored_head(connection, channel, channel_id)
+
+    def channel_seq(self, channel, channel_id):
+        ''' returns the sequence number of the last notification sent to a channel '''
+        with self.shards.engine(channel_id).connect() as connection:
+            last_seq = connection.execute(select([channels.c.last_seq]).where(
+                (channels.c.channel == channel) & (channels.c.channel_id == channel_id))).scalar()
+            if last_seq is None:
+                return self._stored_head(connection, channel, channel_id)
+            return last_seq
+
+    def prune(self, max_age, active_games, batch_size=1000):
+        ''' deletes notifications older than max_age seconds and notifications of games
+        that are not in active_games from every shard, returns how many '''
+        from app.models import Notification
+        table = Notification.__table__
+        cutoff = time() - max_age
+        removed = 0
+        for engine in self.shards.engines:
+            with engine.connect() as connection:
+                games = {id for id, in connection.execute(
+                    select([table.c.game_id]).where(table.c.game_id.isnot(None)).distinct())}
+            abandoned = sorted(games - active_games)
+            condition = table.c.timestamp < cutoff
+            if abandoned:
+                condition |= table.c.game_id.in_(abandoned)
+            while True:
+                # short transactions, so writers to this shard are not blocked for long
+                with engine.begin() as connection:
+                    ids = select([table.c.id]).where(condition).limit(batch_size)
+                    count = connection.execute(table.delete().where(table.c.id.in_(ids))).rowcount
+                removed += count
+                if count < batch_size:
+                    break
+            if abandoned:
+                with engine.begin() as connection:
+                    connection.execute(channels.delete().where(
+                        (channels.c.channel == 'game') & channels.c.channel_id.in_(abandoned)))
+        return removed
+
+
+# a failed shard write fails the commit, so nothing is committed that the players are not told about
+@event.listens_for(SignallingSession, 'before_commit')
+def _write_pending(session):
+    notifications = session.info.get('sharded_notifications')
+    if notifications:
+        from app import notification_shards, broker
+        # a session that writes the main database locks it before the shards, as every session
+        # does; sessions that only send notifications do not touch it
+        session.flush()
+        session.info['shard_transactions'] = notification_shards.prepare(
+            notifications, current_app.config['NOTIFICATIONS_DURABLE'])
+        del session.info['sharded_notifications']
+        for n in notifications:
+            broker.queue(session, n.to_event())
+
+
+# before the broker publishes the events, so readers that fall back to the shards find them
+@event.listens_for(SignallingSession, 'after_commit', insert=True)
+def _commit_pending(session):
+    transactions = session.info.pop('shard_transactions', None)
+    if transactions:
+        from app import notification_shards
+        notification_shards.finish(transactions, commit=True)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('sharded_notifications', None)
+
+
+# also when the session is closed after a failed commit, without a rollback
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def _rollback_pending(session, transaction):
+    transactions = session.info.pop('shard_transactions', None) if transaction.parent is None else None
+    if transactions:
+        from app import notification_shards
+        notification_shards.finish(transactions, commit=False)
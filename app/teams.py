@@ -0,0 +1,88 @@
+from random import Random
+from sqlalchemy import bindparam
+
+
+def assign_teams(player_ids, num_teams, apart=(), seed=None):
+    ''' divides the players randomly over num_teams teams that differ at most one
+    player in size, keeping the players of each pair in apart in different teams
+
+    Returns a dict of player id to team number (starting at 1), raises ValueError
+    when the pairs cannot be kept apart. '''
+    players = list(player_ids)
+    if num_teams < 1:
+        raise ValueError('There must be at least one team')
+    random = Random(seed)
+    random.shuffle(players)
+
+    conflicts = {id: set() for id in players}
+    for a, b in apart:
+        if a in conflicts and b in conflicts and a != b:
+            conflicts[a].add(b)
+            conflicts[b].add(a)
+
+    # teams fill up to the larger size only as often as the players do not divide evenly
+    small, extra = divmod(len(players), num_teams)
+    sizes = [0] * num_teams
+    members = [set() for _ in range(num_teams)]
+    teams = {}
+
+    def candidates(id):
+        full = small + 1 if extra else small
+        return [t for t in range(num_teams) if sizes[t] < full and not members[t] & conflicts[id]]
+
+    def options(id):
+        # the smallest teams first; empty teams are interchangeable, so one of them is enough
+        teams = sorted(candidates(id), key=lambda t: sizes[t])
+        return teams[:1] + [t for t in teams[1:] if sizes[t]]
+
+    def join(id, team):
+        nonlocal extra
+        members[team].add(id)
+        sizes[team] += 1
+        if sizes[team] == small + 1:
+            extra -= 1
+        teams[id] = team
+
+    def leave(id):
+        nonlocal extra
+        team = teams.pop(id)
+        if sizes[team] == small + 1:
+            extra += 1
+        sizes[team] -= 1
+        members[team].discard(id)
+
+    # search the teams of the players in pairs, backtracking when one has no team left
+    unplaced = [id for id in players if conflicts[id]]
+    placed = []
+    while unplaced:
+        # the player with the fewest teams left first, ties in the shuffled order
+        id = min(unplaced, key=lambda id: len(candidates(id)))
+        left = options(id)
+        while not left:
+            if not placed:
+                raise ValueError('The players cannot be kept apart in {} teams'.format(num_teams))
+            id, left = placed.pop()
+            leave(id)
+            unplaced.append(id)
+        join(id, left.pop(0))
+        unplaced.remove(id)
+        placed.append((id, left))
+
+    # the other players fit anywhere, so fill up the smallest teams
+    for id in players:
+        if id not in teams:
+            join(id, min(candidates(id), key=lambda t: sizes[t]))
+    return {id: team + 1 for id, team in teams.items()}
+
+def save_teams(game, teams):
+    ''' writes the teams of the players of the game in one statement '''
+    from app import db
+    from app.models import User
+    rows = [{'user_id': id, 'new_team': team} for id, team in teams.items()]
+    if not rows:
+        return 0
+    db.session.execute(User.__table__.update().where(
+        (User.id == bindparam('user_id')) & (User.game_id == game.id)).values(team=bindparam('new_team')), rows)
+    # the teams are part of the cached identities of the players
+    db.session.info.setdefault('changed_users', set()).update(teams)
+    return len(rows)
@@ -0,0 +1,46 @@
+''' Benchmarks for Who is the man, run as modules from the repository root, e.g.
+
+    python -m benchmarks.join_tokens
+'''
+from config import Config
+from contextlib import contextmanager
+from sqlalchemy import event
+from time import perf_counter
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+
+
+@contextmanager
+def count_queries(engine):
+    ''' records the SQL statements that are executed '''
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def percentile(values, p):
+    ''' returns the p-th percentile of the values (nearest rank) '''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+@contextmanager
+def timer():
+    ''' measures the elapsed time in seconds as result[0] '''
+    result = [0.0]
+    start = perf_counter()
+    try:
+        yield result
+    finally:
+        result[0] = perf_counter() - start
@@ -0,0 +1,52 @@
+''' Measures a burst of players verifying the same join token, with and without
+the verified-token cache '''
+from app import create_app, db
+from app.models import Game, User
+from benchmarks import BenchConfig, count_queries, timer
+import argparse
+import jwt
+
+
+def burst(app, token, joins, cached):
+    decodes = [0]
+    decode = jwt.decode
+    def counting_decode(*args, **kwargs):
+        decodes[0] += 1
+        return decode(*args, **kwargs)
+    jwt.decode = counting_decode
+    try:
+        with count_queries(db.engine) as statements, timer() as elapsed:
+            for _ in range(joins):
+                if not cached:
+                    app.extensions.get('caches', {}).pop('join_tokens', None)
+                # every join is a new request with a new session
+                db.session.remove()
+                Game.verify_join_token(token).name
+    finally:
+        jwt.decode = decode
+    return {'seconds': elapsed[0], 'decodes': decodes[0], 'queries': len(statements)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--joins', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        g = Game(name='BenchGame')
+        g.set_host(User(username='BenchHost'))
+        db.session.add(g)
+        db.session.commit()
+        token = g.get_join_token()
+
+        for cached in (False, True):
+            result = burst(app, token, args.joins, cached)
+            print('{:<9} {:>6} joins: {:8.1f} ms, {:>5} decodes, {:>5} queries'.format(
+                'cached' if cached else 'uncached', args.joins, result['seconds'] * 1000,
+                result['decodes'], result['queries']))
+
+
+if __name__ == '__main__':
+    main()
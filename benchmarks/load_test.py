@@ -0,0 +1,194 @@
+''' Simulates concurrent games: every game has a host and players who register,
+join through the invite link, open the lobby and poll for notifications while
+the host sets up the game. Reports throughput and latency percentiles per
+endpoint and writes them to a JSON file that can be compared across commits.
+
+    python -m benchmarks.load_test --games 10 --players 8 --output load_test.json
+    python -m benchmarks.load_test --server --concurrency 16
+'''
+from app import create_app, db
+from benchmarks import BenchConfig, percentile
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from http.cookiejar import CookieJar
+from time import perf_counter
+from urllib.parse import urlencode, quote
+import urllib.request
+import urllib.error
+import subprocess
+import threading
+import tempfile
+import argparse
+import logging
+import json
+import os
+import re
+
+
+class TestClientSession(object):
+    ''' A player talking to the app through the Flask test client '''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        rv = self.client.open(path, method=method, data=data)
+        return rv.status_code, rv.data
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPSession(object):
+    ''' A player talking to the app over HTTP, with its own cookies '''
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, body, method=method)) as rv:
+                return rv.status, rv.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Recorder(object):
+    ''' Collects the latency of every request per endpoint '''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __call__(self, session, endpoint, method, path, data=None, expect=(200, 302)):
+        start = perf_counter()
+        status, body = session.request(method, path, data)
+        elapsed = perf_counter() - start
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if status not in expect:
+                self.errors[endpoint] += 1
+        return status, body
+
+    def report(self, wall_time):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput': len(latencies) / wall_time,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+            }
+        total = sum(len(l) for l in self.latencies.values())
+        return {'wall_time': wall_time, 'requests': total, 'throughput': total / wall_time,
+                'endpoints': endpoints}
+
+
+def play_host(record, session, game):
+    ''' registers, creates a game and returns the join path from the invite link '''
+    record(session, 'auth.register', 'POST', '/register', {'username': 'host-%d' % game})
+    record(session, 'auth.create_game', 'POST', '/create_game', {'name': 'game-%d' % game})
+    status, body = record(session, 'auth.lobby', 'GET', '/index')
+    return re.search(rb'href="[^"]*(/join_game/[^"/]+)"', body).groups()[0].decode()
+
+
+def play_player(record, session, game, player, join_path, polls):
+    next_page = quote(join_path, safe='')
+    record(session, 'auth.register', 'POST', '/register?next=' + next_page,
+           {'username': 'player-%d-%d' % (game, player)})
+    record(session, 'auth.join_game', 'GET', join_path)
+    record(session, 'auth.lobby', 'GET', '/index')
+    for _ in range(polls):
+        record(session, 'main.notifications', 'GET', '/notifications?game_since=0&user_since=0')
+
+
+def setup_game(record, session):
+    record(session, 'main.init_game', 'GET', '/init_game')
+    record(session, 'main.init_game', 'POST', '/init_game',
+           {'num_cards': 3, 'num_rounds': 3, 'round_time': 30})
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=5)
+    parser.add_argument('--players', type=int, default=6, help='players per game, besides the host')
+    parser.add_argument('--polls', type=int, default=10, help='notification polls per player')
+    parser.add_argument('--server', action='store_true', help='run a threaded local WSGI server')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads with --server')
+    parser.add_argument('--output', default='load_test.json')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    class LoadTestConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'load_test.db')
+    app = create_app(LoadTestConfig)
+    with app.app_context():
+        db.create_all()
+
+    server = None
+    if args.server:
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+        new_session = lambda: HTTPSession(base_url)
+        workers = args.concurrency
+    else:
+        new_session = lambda: TestClientSession(app)
+        workers = 1
+
+    record = Recorder()
+    start = perf_counter()
+    hosts = [new_session() for _ in range(args.games)]
+    with ThreadPoolExecutor(workers) as pool:
+        join_paths = list(pool.map(lambda g: play_host(record, hosts[g], g), range(args.games)))
+        players = [pool.submit(play_player, record, new_session(), g, p, join_paths[g], args.polls)
+                   for g in range(args.games) for p in range(args.players)]
+        for future in players:
+            future.result()
+        for future in [pool.submit(setup_game, record, hosts[g]) for g in range(args.games)]:
+            future.result()
+    wall_time = perf_counter() - start
+    if server is not None:
+        server.shutdown()
+
+    result = record.report(wall_time)
+    result.update({
+        'commit': git_commit(),
+        'mode': 'server' if args.server else 'test_client',
+        'games': args.games, 'players': args.players, 'polls': args.polls,
+        'concurrency': workers,
+    })
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print('{:<22} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, stats in result['endpoints'].items():
+        print('{:<22} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            endpoint, stats['requests'], stats['errors'], stats['throughput'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('{} requests in {:.2f} s ({:.1f} req/s), written to {}'.format(
+        result['requests'], wall_time, result['throughput'], args.output))
+
+
+if __name__ == '__main__':
+    main()
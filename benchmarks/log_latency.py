@@ -0,0 +1,77 @@
+''' Measures how long logging an error blocks a request, with the old synchronous
+SMTP and file handlers and with the queue pipeline, against an SMTP server that
+takes --smtp-ms to answer '''
+from app import create_app, log_pipeline
+from benchmarks import BenchConfig, percentile
+from logging.handlers import SMTPHandler, RotatingFileHandler
+from unittest.mock import patch
+from time import perf_counter, sleep
+import tempfile
+import argparse
+import logging
+import os
+
+
+def make_config(log_dir):
+    class LogConfig(BenchConfig):
+        LOG_DIR = log_dir
+        MAIL_SERVER = 'localhost'
+    return LogConfig
+
+
+def synchronous(app, log_dir):
+    ''' the handlers create_app used to attach '''
+    mail_handler = SMTPHandler(mailhost=('localhost', 25), fromaddr='no-reply@localhost',
+                               toaddrs=app.config['ADMINS'], subject='WitM error notification')
+    mail_handler.setLevel(logging.ERROR)
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'sync.log'), maxBytes=10240, backupCount=10)
+    file_handler.setLevel(logging.INFO)
+    for handler in (mail_handler, file_handler):
+        app.logger.addHandler(handler)
+    app.logger.setLevel(logging.INFO)
+    return mail_handler, file_handler
+
+
+def measure(app, errors):
+    times = []
+    with app.test_request_context('/'):
+        for i in range(errors):
+            start = perf_counter()
+            app.logger.error('Something failed %d', i)
+            times.append(perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--errors', type=int, default=50)
+    parser.add_argument('--smtp-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    def slow_smtp(*a, **kw):
+        sleep(args.smtp_ms / 1000)
+        return smtp.return_value
+
+    print('{:<12} {:>8} {:>8} {:>8} {:>7}'.format('handlers', 'p50 ms', 'p99 ms', 'total ms', 'mails'))
+    for name in ('synchronous', 'queue'):
+        log_dir = tempfile.mkdtemp()
+        with patch('smtplib.SMTP', side_effect=slow_smtp) as smtp:
+            app = create_app(make_config(log_dir))
+            handlers = ()
+            if name == 'queue':
+                log_pipeline.start(app)
+                smtp.reset_mock()
+            else:
+                handlers = synchronous(app, log_dir)
+            times = measure(app, args.errors)
+            # waits for the queued records to be written out
+            log_pipeline.stop(app)
+            for handler in handlers:
+                app.logger.removeHandler(handler)
+            print('{:<12} {:>8.2f} {:>8.2f} {:>8.1f} {:>7}'.format(
+                name, percentile(times, 50) * 1000, percentile(times, 99) * 1000, sum(times) * 1000,
+                smtp.return_value.send_message.call_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+''' Measures the round scheduler with many active timers: the cost of scheduling,
+rescheduling and popping them, its memory, and how late the scheduler thread
+fires them and how much CPU it uses while doing so '''
+from app.rounds import Scheduler
+from benchmarks import percentile, timer
+from time import time, sleep, process_time
+import tracemalloc
+import argparse
+import random
+
+
+def operations(timers):
+    scheduler = Scheduler(None)
+    now = time()
+    deadlines = [now + random.uniform(10, 120) for _ in range(timers)]
+    tracemalloc.start()
+    with timer() as scheduling:
+        for game_id, deadline in enumerate(deadlines):
+            scheduler.schedule(game_id, deadline)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    with timer() as rescheduling:
+        for game_id, deadline in enumerate(deadlines):
+            scheduler.schedule(game_id, deadline + 1)
+    with timer() as popping:
+        due = scheduler.pop_due(now + 200)
+    assert len(due) == timers
+    return {'schedule': scheduling[0], 'reschedule': rescheduling[0], 'pop': popping[0], 'memory': memory}
+
+
+def firing(timers, spread):
+    start = time()
+    deadlines = [start + 0.1 + random.uniform(0, spread) for _ in range(timers)]
+    lateness = []
+    scheduler = Scheduler(lambda game_id: lateness.append(time() - deadlines[game_id]))
+    scheduler.start()
+    cpu = process_time()
+    for game_id, deadline in enumerate(deadlines):
+        scheduler.schedule(game_id, deadline)
+    while len(lateness) < timers and time() < start + spread + 5:
+        sleep(0.05)
+    return lateness, process_time() - cpu, time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--timers', type=int, default=10000)
+    parser.add_argument('--spread', type=float, default=2, help='seconds over which the timers fire')
+    args = parser.parse_args()
+
+    ops = operations(args.timers)
+    print('{} timers: schedule {:.2f} us, reschedule {:.2f} us, pop {:.2f} us per timer, {:.0f} bytes per timer'.format(
+        args.timers, ops['schedule'] / args.timers * 1e6, ops['reschedule'] / args.timers * 1e6,
+        ops['pop'] / args.timers * 1e6, ops['memory'] / args.timers))
+
+    lateness, cpu, wall = firing(args.timers, args.spread)
+    print('fired {} timers over {:.1f} s: late by p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms; {:.1f}% of a CPU'.format(
+        len(lateness), wall, percentile(lateness, 50) * 1000, percentile(lateness, 99) * 1000,
+        max(lateness) * 1000, cpu / wall * 100))
+
+
+if __name__ == '__main__':
+    main()
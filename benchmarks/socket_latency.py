@@ -0,0 +1,133 @@
+''' Measures how long a game event takes to reach another player through a server on a
+local port (app.server, as python who-is-the-man.py runs it): pushed over the game
+socket as a WebSocket or as Socket.IO long polling, and picked up by the 2 second
+notification poll of the browser.
+
+The poll interval is not slept through: the polling latency of each event is the
+measured poll request plus a uniformly distributed wait for the next poll.
+
+Needs requests and websocket-client for the clients.
+'''
+from app import create_app, db
+from app.models import Game
+from app.server import serve
+from benchmarks import BenchConfig, percentile
+from multiprocessing import Process
+from time import perf_counter, sleep
+import threading
+import requests
+import socketio
+import tempfile
+import argparse
+import random
+import os
+
+
+def make_config(database):
+    class ServerConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database
+    return ServerConfig
+
+
+def run_server(database, bind):
+    app = create_app(make_config(database))
+    with app.app_context():
+        db.create_all()
+    serve(app, bind)
+
+
+def wait_for(url, timeout=10):
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            return requests.get(url + '/register')
+        except requests.ConnectionError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.1)
+
+
+def players(url, database):
+    host, player = requests.Session(), requests.Session()
+    host.post(url + '/register', data={'username': 'BenchHost'})
+    host.post(url + '/create_game', data={'name': 'BenchGame'})
+    with create_app(make_config(database)).app_context():
+        token = Game.query.filter_by(name='BenchGame').first().get_join_token()
+        db.session.remove()
+    player.post(url + '/register', data={'username': 'BenchPlayer'})
+    player.get(url + '/join_game/' + token)
+    return host, player
+
+
+def connect(url, session, transport):
+    client = socketio.Client()
+    cookie = '; '.join('{}={}'.format(k, v) for k, v in session.cookies.items())
+    client.connect(url, headers={'Cookie': cookie}, namespaces=['/game'], transports=[transport])
+    return client
+
+
+def socket_round_trips(url, host, player, events, transport):
+    host_socket, player_socket = connect(url, host, transport), connect(url, player, transport)
+    received = threading.Event()
+    host_socket.on('notification', lambda n: received.set(), namespace='/game')
+    latencies = []
+    for i in range(events):
+        received.clear()
+        start = perf_counter()
+        player_socket.call('game_event', {'name': 'guess', 'data': {'guess': i}}, namespace='/game')
+        assert received.wait(5)
+        latencies.append(perf_counter() - start)
+    transports = host_socket.transport()
+    host_socket.disconnect()
+    player_socket.disconnect()
+    assert transports == transport, transports
+    return latencies
+
+
+def poll_round_trips(url, host, player, events, interval):
+    since = host.get(url + '/notifications?game_since=0&user_since=0').json()[-1]['seq']
+    player_socket = connect(url, player, 'websocket')
+    latencies = []
+    for i in range(events):
+        start = perf_counter()
+        player_socket.call('game_event', {'name': 'guess', 'data': {'guess': i}}, namespace='/game')
+        rv = host.get(url + '/notifications?game_since={}&user_since=0'.format(since))
+        since = rv.json()[-1]['seq']
+        latencies.append(perf_counter() - start + random.uniform(0, interval))
+    player_socket.disconnect()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=2, help='poll interval of the browser in seconds')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'bench.db')
+        server = Process(target=run_server, args=(database, url[len('http://'):]), daemon=True)
+        server.start()
+        try:
+            wait_for(url)
+            host, player = players(url, database)
+            results = [
+                ('websocket', socket_round_trips(url, host, player, args.events, 'websocket')),
+                ('polling', socket_round_trips(url, host, player, args.events, 'polling')),
+                ('poll', poll_round_trips(url, host, player, args.events, args.interval)),
+            ]
+        finally:
+            server.terminate()
+            server.join()
+
+    print('{:<10} {:>9} {:>9} {:>9} {:>9}'.format('path', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, latencies in results:
+        print('{:<10} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, sum(latencies) / len(latencies) * 1000, percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
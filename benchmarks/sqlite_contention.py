@@ -0,0 +1,88 @@
+''' Runs worker processes that poll notifications and send them against one SQLite
+file, with SQLAlchemy's defaults and with the sqlite profile (WAL, busy_timeout,
+synchronous=NORMAL), and with the notifications in K shard files, and reports
+throughput, latency and lock errors '''
+from app import create_app, db
+from app.models import Game, Notification
+from benchmarks import BenchConfig, percentile
+from multiprocessing import Pool
+from sqlalchemy.exc import OperationalError
+from time import perf_counter
+import tempfile
+import argparse
+import random
+import os
+
+
+def make_config(path, profile, shards=0):
+    class ContentionConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        DATABASE_PROFILE = profile
+        NOTIFICATION_SHARDS = shards
+        NOTIFICATION_SHARD_URL = 'sqlite:///' + path + '-{}'
+    return ContentionConfig
+
+
+def worker(args):
+    path, profile, shards, games, seconds, write_ratio = args
+    app = create_app(make_config(path, profile, shards))
+    reads, writes, errors = [], [], 0
+    with app.app_context():
+        end = perf_counter() + seconds
+        while perf_counter() < end:
+            game_id = random.randint(1, games)
+            start = perf_counter()
+            try:
+                if random.random() < write_ratio:
+                    Game.query.get(game_id).add_notification('bench', {'value': 1})
+                    db.session.commit()
+                    writes.append(perf_counter() - start)
+                else:
+                    Notification.channel_page('game', game_id, 0, 20)
+                    reads.append(perf_counter() - start)
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+            finally:
+                db.session.remove()
+    return reads, writes, errors
+
+
+def run(profile, shards, workers, games, seconds, write_ratio):
+    path = os.path.join(tempfile.mkdtemp(), 'contention.db')
+    app = create_app(make_config(path, profile, shards))
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Game(name='BenchGame%d' % i) for i in range(games)])
+        db.session.commit()
+        db.get_engine(app).dispose()
+    with Pool(workers) as pool:
+        results = pool.map(worker, [(path, profile, shards, games, seconds, write_ratio)] * workers)
+    reads = [t for r, w, e in results for t in r]
+    writes = [t for r, w, e in results for t in w]
+    errors = sum(e for r, w, e in results)
+    return reads, writes, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--shards', type=int, nargs='*', default=[2, 4], help='numbers of notification shards')
+    args = parser.parse_args()
+
+    print('{:<10} {:>8} {:>8} {:>7} {:>12} {:>12} {:>13} {:>13}'.format(
+        'profile', 'reads/s', 'writes/s', 'errors', 'read p50 ms', 'read p99 ms', 'write p50 ms', 'write p99 ms'))
+    runs = [('default', 0), ('sqlite', 0)] + [('sqlite', shards) for shards in args.shards]
+    for profile, shards in runs:
+        reads, writes, errors = run(profile, shards, args.workers, args.games, args.seconds, args.write_ratio)
+        print('{:<10} {:>8.0f} {:>8.0f} {:>7} {:>12.2f} {:>12.2f} {:>13.2f} {:>13.2f}'.format(
+            profile + ('/%d' % shards if shards else ''), len(reads) / args.seconds, len(writes) / args.seconds, errors,
+            percentile(reads, 50) * 1000, percentile(reads, 99) * 1000,
+            percentile(writes, 50) * 1000, percentile(writes, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
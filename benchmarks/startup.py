@@ -0,0 +1,48 @@
+''' Measures a cold start of a worker in fresh interpreters: importing the app,
+create_app and the first request, and which slow extensions got imported '''
+from benchmarks import percentile
+import subprocess
+import argparse
+import json
+import sys
+
+COLD_START = '''
+from time import perf_counter
+import json, sys
+start = perf_counter()
+from app import create_app
+imported = perf_counter()
+from benchmarks import BenchConfig
+app = create_app(BenchConfig)
+created = perf_counter()
+with app.test_client() as c:
+    c.get('/register')
+requested = perf_counter()
+print(json.dumps({
+    'import': imported - start, 'create_app': created - imported, 'first_request': requested - created,
+    'modules': [m for m in sys.argv[1:] if m in sys.modules]}))
+'''
+
+SLOW_MODULES = ['flask_migrate', 'alembic', 'flask_mail', 'flask_qrcode', 'PIL',
+                'flask_bootstrap', 'flask_babel']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    results = [json.loads(subprocess.run(
+        [sys.executable, '-c', COLD_START] + SLOW_MODULES,
+        stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout) for _ in range(args.runs)]
+    print('{:<14} {:>8} {:>8}'.format('phase', 'p50 ms', 'max ms'))
+    for phase in ('import', 'create_app', 'first_request'):
+        times = [r[phase] for r in results]
+        print('{:<14} {:>8.1f} {:>8.1f}'.format(phase, percentile(times, 50) * 1000, max(times) * 1000))
+    total = [r['import'] + r['create_app'] + r['first_request'] for r in results]
+    print('{:<14} {:>8.1f} {:>8.1f}'.format('total', percentile(total, 50) * 1000, max(total) * 1000))
+    print('imported after the first request: ' + ', '.join(results[0]['modules']))
+
+
+if __name__ == '__main__':
+    main()
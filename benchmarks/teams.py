@@ -0,0 +1,61 @@
+''' Measures dividing large games over teams and saving the teams, with the bulk
+update against setting User.team on every player through the ORM '''
+from app import create_app, db
+from app.models import Game, User
+from app.teams import assign_teams, save_teams
+from benchmarks import BenchConfig, count_queries, timer
+import argparse
+import random
+
+
+def create_game(players):
+    game = Game(name='BenchGame%d' % players)
+    game.set_host(User(username='BenchHost%d' % players))
+    db.session.add(game)
+    db.session.flush()
+    db.session.bulk_insert_mappings(User, [
+        {'username': 'BenchPlayer%d-%d' % (players, i), 'game_id': game.id} for i in range(players - 1)])
+    db.session.commit()
+    return game.id
+
+
+def orm_save(game, teams):
+    for user in game.players:
+        user.team = teams[user.id]
+
+
+def run(game_id, num_teams, pairs, save):
+    db.session.remove()
+    game = Game.query.get(game_id)
+    ids = [id for id, in game.players.with_entities(User.id)]
+    apart = [tuple(random.sample(ids, 2)) for _ in range(pairs)]
+    with timer() as assigning:
+        teams = assign_teams(ids, num_teams, apart)
+    with count_queries(db.engine) as statements, timer() as saving:
+        save(game, teams)
+        db.session.commit()
+    return assigning[0], saving[0], len(statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--players', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--teams', type=int, default=4)
+    parser.add_argument('--pairs', type=int, default=20, help='pairs of players to keep apart')
+    args = parser.parse_args()
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        print('{:>8} {:>12} {:>10} {:>12} {:>10} {:>12}'.format(
+            'players', 'assign ms', 'bulk ms', 'bulk queries', 'orm ms', 'orm queries'))
+        for players in args.players:
+            game_id = create_game(players)
+            assigning, bulk, bulk_queries = run(game_id, args.teams, args.pairs, save_teams)
+            _, orm, orm_queries = run(game_id, args.teams, args.pairs, orm_save)
+            print('{:>8} {:>12.2f} {:>10.2f} {:>12} {:>10.2f} {:>12}'.format(
+                players, assigning * 1000, bulk * 1000, bulk_queries, orm * 1000, orm_queries))
+
+
+if __name__ == '__main__':
+    main()
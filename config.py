@@ -11,6 +11,14 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
             'sqlite:///' + os.path.join(basedir , 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Engine settings: 'sqlite' uses WAL and waits for locks, 'postgresql' keeps a pool of
+    # connections with timeouts (in milliseconds), 'auto' picks by the URL, 'default' changes nothing
+    DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE') or 'auto'
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_STATEMENT_TIMEOUT = 5000
+    DATABASE_LOCK_TIMEOUT = 2000
+    SQLITE_BUSY_TIMEOUT = 5000
     CSRF_ENABLED = True
     CSRF_SESSION_KEY = os.environ.get('CSRF_SESSION_KEY') or "7cYR^6GIfnu44EMM3kusmK6^$L^7Pe@TMA7hsLv*dfpbr!sgaoRbu"
 
@@ -23,3 +31,84 @@ class Config(object):
     ADMINS = ['oleterhaar@pm.me']
 
     ROLES = {'HOST' : 1, 'PLAYER': 2}
+
+    # Join tokens are reissued every epoch (in seconds), QR codes are cached per epoch
+    JOIN_TOKEN_EPOCH = 300
+    QRCODE_CACHE_SIZE = 256
+    # Verified join tokens are cached until they expire, invalid ones for the TTL (in seconds)
+    JOIN_TOKEN_CACHE_SIZE = 1024
+    JOIN_TOKEN_CACHE_TTL = 60
+    # The identities of logged in users are cached for a short time (in seconds)
+    USER_CACHE_SIZE = 4096
+    USER_CACHE_TTL = 30
+    # Rendered player lists of the lobby are cached per version of the players of a game
+    LOBBY_CACHE_SIZE = 1024
+
+    # Users count as online if they were seen within the timeout (in seconds),
+    # when they were last seen is written to the database every flush interval
+    PRESENCE_TIMEOUT = 60
+    PRESENCE_FLUSH_INTERVAL = 60
+
+    # Notification stream settings (in seconds): a keep-alive is sent after each
+    # interval without notifications, the stream is closed after the timeout
+    NOTIFICATION_STREAM_INTERVAL = 15
+    NOTIFICATION_STREAM_TIMEOUT = 60
+    # Maximum number of notifications per channel in a single response
+    NOTIFICATIONS_PAGE_SIZE = 100
+
+    # Broker that passes notifications between requests: 'memory' within a single
+    # process, 'file' for several workers on one host
+    NOTIFICATION_BROKER = os.environ.get('NOTIFICATION_BROKER') or 'memory'
+    NOTIFICATION_BROKER_DIR = os.environ.get('NOTIFICATION_BROKER_DIR') or os.path.join(basedir, 'events')
+    # Number of recent notifications per channel the broker keeps
+    NOTIFICATION_BROKER_HISTORY = 100
+    # Seconds the memory broker trusts what it knows of a channel before reading the database
+    # again, so events written by other workers are delivered within that time (0: forever,
+    # only for a single worker)
+    NOTIFICATION_BROKER_TTL = float(os.environ.get('NOTIFICATION_BROKER_TTL') or 5)
+    # Seconds after which the broker forgets channels without events
+    NOTIFICATION_BROKER_IDLE = 300
+    # Also store notifications in the database, so clients can catch up from further back
+    NOTIFICATIONS_DURABLE = os.environ.get('NOTIFICATIONS_DURABLE', '1') != '0'
+
+    # Game events are also pushed over Socket.IO. The app runs blocking database calls and
+    # background threads, so it is served in threading mode, over WebSockets with
+    # simple-websocket under gunicorn's threaded worker (python who-is-the-man.py).
+    # Several workers need a message queue such as redis://
+    SOCKETIO_ASYNC_MODE = 'threading'
+    # Largest data of a game event sent by a player, in bytes of JSON
+    GAME_EVENT_MAX_BYTES = 1024
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+    # Store notifications and the sequence numbers of their channels in this many databases,
+    # picked by game (or user) id, instead of the main database (0), so sending them does not
+    # lock the main database; their tables are created when the app starts
+    NOTIFICATION_SHARDS = int(os.environ.get('NOTIFICATION_SHARDS') or 0)
+    NOTIFICATION_SHARD_URL = os.environ.get('NOTIFICATION_SHARD_URL') or \
+            'sqlite:///' + os.path.join(basedir, 'notifications-{}.db')
+
+    # Notifications are deleted after the retention time (in seconds), by `flask notifications prune`
+    # or by a background thread every prune interval (0 disables it)
+    NOTIFICATION_RETENTION = 24 * 60 * 60
+    NOTIFICATION_PRUNE_INTERVAL = int(os.environ.get('NOTIFICATION_PRUNE_INTERVAL') or 0)
+    NOTIFICATION_PRUNE_BATCH_SIZE = 1000
+
+    # Rounds are ended on time by a scheduler thread in every process
+    ROUND_SCHEDULER = os.environ.get('ROUND_SCHEDULER', '1') != '0'
+    # Seconds a worker waits past the end of a round it picked up at start, so the worker
+    # that holds the deck ends it with the guessed cards
+    ROUND_RECOVERY_GRACE = 5
+
+    # Per endpoint request metrics are served at /metrics, only with this bearer token if it is set;
+    # requests that take longer than the threshold (in seconds) are logged
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 1)
+
+    # Outside debug and testing, log records are written as JSON lines to a file in LOG_DIR that
+    # is rotated at LOG_FILE_MAX_BYTES; errors are mailed to the admins at most once per
+    # LOG_MAIL_INTERVAL (in seconds), with at most LOG_MAIL_CAPACITY errors per mail
+    LOG_DIR = os.environ.get('LOG_DIR') or os.path.join(basedir, 'logs')
+    LOG_FILE_MAX_BYTES = int(os.environ.get('LOG_FILE_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_FILE_BACKUPS = 10
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)
+    LOG_MAIL_CAPACITY = 50
@@ -1,11 +1,30 @@
 from datetime import datetime, timedelta
 import unittest
-from app import create_app, db
-from app.models import User, Game, Setting, Notification
+from app import create_app, db, presence, socketio, rounds, decks, mail, log_pipeline, broker
+from app.models import User, Game, Setting, Notification, Card, user_cache
 from config import Config
 from flask import template_rendered, url_for, jsonify
 from flask_login import current_user
 from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app.broker import Event, MemoryBackend, FileBackend
+from app.main import events as game_events
+from time import time, monotonic, sleep
+from app.rounds import Scheduler
+from app.deck import Deck
+from app.teams import assign_teams
+from app.database import engine_options
+from app.retention import prune_notifications
+from app.log import BatchingSMTPHandler
+import logging
+import json
+import tempfile
+import subprocess
+import sys
+import os
+from unittest.mock import patch
+from app.auth.forms import CreateGameForm
 import re
 
 # from https://stackoverflow.com/questions/23987564/test-flask-render-template-context
@@ -20,6 +39,18 @@ def captured_templates(app):
     finally:
         template_rendered.disconnect(record, app)
 
+@contextmanager
+def count_queries():
+    ''' records the SQL statements that are executed '''
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
@@ -92,6 +123,143 @@ class AuthModuleCase(unittest.TestCase):
             rv = c.get(url_for('main.notifications') + '?since=0')
             self.assertEqual(rv.status_code, 200)
             self.assertIn(b'test_notification', rv.data)
+            self.assertEqual(rv.get_json(), [{'name': 'test_notification', 'data': {'test_key': 'test_value'},
+                                              'channel': 'user', 'seq': 1}])
+            rv = c.get(url_for('main.notifications') + '?user_since=1')
+            self.assertEqual(rv.get_json(), [])
+
+    def test_conditional_notifications(self):
+        ''' tests that polls without new notifications are answered with a 304 without
+        reading the notifications '''
+        with self.app.test_client() as c:
+            self.login(c)
+            rv = c.get('/notifications?user_since=0&game_since=0')
+            self.assertEqual(rv.get_json(), [])
+            etag = rv.headers['ETag']
+            with count_queries() as statements:
+                rv = c.get('/notifications?user_since=0&game_since=0', headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertFalse([s for s in statements if 'notification' in s])
+
+            current_user.add_notification('test_notification', {})
+            db.session.commit()
+            rv = c.get('/notifications?user_since=0&game_since=0', headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()[0]['seq'], 1)
+            rv = c.get('/notifications?user_since=1&game_since=0', headers={'If-None-Match': etag})
+            self.assertEqual(rv.get_json(), [])
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_lobby_state(self):
+        ''' tests that the lobby state is answered with a 304 until a player joins '''
+        g = Game(name="TestGame")
+        g.set_host(User(username="TestHost"))
+        db.session.add(g)
+        db.session.commit()
+        token = g.get_join_token()
+
+        with self.app.test_client() as c:
+            self.login(c)
+            c.get('/join_game/' + token)
+            rv = c.get('/lobby/state')
+            self.assertEqual(rv.get_json(), {'game': 'TestGame', 'players': [
+                {'username': 'TestHost', 'is_host': True, 'online': True},
+                {'username': 'TestUser', 'is_host': False, 'online': True}]})
+            etag = rv.headers['ETag']
+            rv = c.get('/lobby/state', headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+
+            # players seen by another worker are only known from the database
+            host_id = User.query.filter_by(username='TestHost').first().id
+            for last_seen, online in ((datetime.utcnow() - timedelta(hours=1), False), (datetime.utcnow(), True)):
+                User.query.filter_by(id=host_id).update({'last_seen': last_seen})
+                db.session.commit()
+                rv = c.get('/lobby/state')
+                self.assertEqual(rv.get_json()['players'][0]['online'], online)
+            rv = c.get('/lobby/state', headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+
+            with self.app.test_client() as other:
+                other.post('/register', data={'username': 'LatePlayer'})
+                other.get('/join_game/' + token)
+            rv = c.get('/lobby/state', headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(rv.get_json()['players']), 3)
+
+    def test_notification_stream(self):
+        ''' tests the server-sent event stream of notifications '''
+        self.app.config['NOTIFICATION_STREAM_TIMEOUT'] = 0
+        with self.app.test_client() as c:
+            self.login(c)
+            current_user.add_notification('first_notification', {'test_key':'first_value'})
+            db.session.commit()
+            rv = c.get(url_for('main.notifications_stream'))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.mimetype, 'text/event-stream')
+            self.assertIn(b'id: 0-1\nevent: first_notification\ndata: {"test_key": "first_value"}\n\n', rv.data)
+
+            # resuming with Last-Event-ID only sends newer notifications
+            current_user.add_notification('second_notification', {'test_key':'second_value'})
+            db.session.commit()
+            rv = c.get(url_for('main.notifications_stream'), headers={'Last-Event-ID': '0-1'})
+            self.assertNotIn(b'first_notification', rv.data)
+            self.assertIn(b'second_notification', rv.data)
+
+    def test_game_socket(self):
+        ''' tests that game events are pushed to the players over the game socket '''
+        # served from threads, like the scheduler and the streams that emit to it
+        self.assertEqual(socketio.server.async_mode, 'threading')
+        # with simple-websocket the clients upgrade to a WebSocket
+        self.assertIsNotNone(socketio.server.eio._async['websocket'])
+        # anonymous sockets are not let in
+        with self.app.test_request_context():
+            self.assertFalse(game_events.connect())
+
+        with self.app.test_client() as host, self.app.test_client() as player:
+            host.post('/register', data={'username': 'TestHost'})
+            host.post('/create_game', data={'name': 'TestGame'})
+            token = Game.query.filter_by(name='TestGame').first().get_join_token()
+            player.post('/register', data={'username': 'TestPlayer'})
+            player.get('/join_game/' + token)
+            db.session.remove()
+
+            host_socket = socketio.test_client(self.app, namespace='/game', flask_test_client=host)
+            player_socket = socketio.test_client(self.app, namespace='/game', flask_test_client=player)
+            self.assertTrue(player_socket.is_connected('/game'))
+
+            # catching up from the start of the game
+            missed = player_socket.emit('sync', {'game': 0, 'user': 0}, namespace='/game', callback=True)
+            self.assertEqual([n['name'] for n in missed], ['new_player_joined'])
+            host_socket.get_received('/game')
+            for cursor in ([1], {'game': 'first'}, None):
+                self.assertIn('error', player_socket.emit('sync', cursor, namespace='/game', callback=True))
+            ack = player_socket.emit('game_event', {'name': 'guess', 'data': {'guess': 'x' * 2000}},
+                                     namespace='/game', callback=True)
+            self.assertIn('error', ack)
+            self.assertEqual(host_socket.get_received('/game'), [])
+
+            ack = player_socket.emit('game_event', {'name': 'guess', 'data': {'guess': 'Napoleon'}},
+                                     namespace='/game', callback=True)
+            self.assertEqual(ack, {'seq': 2})
+            received = host_socket.get_received('/game')
+            self.assertEqual(received[0]['args'][0], {'name': 'guess', 'channel': 'game', 'seq': 2,
+                                                      'data': {'guess': 'Napoleon', 'username': 'TestPlayer'}})
+
+            # only the host controls the turns
+            ack = player_socket.emit('game_event', {'name': 'turn_started'}, namespace='/game', callback=True)
+            self.assertIn('error', ack)
+            ack = host_socket.emit('game_event', {'name': 'turn_started'}, namespace='/game', callback=True)
+            self.assertEqual(ack, {'seq': 3})
+            self.assertEqual(player_socket.get_received('/game')[-1]['args'][0]['name'], 'turn_started')
+
+            # the events can be polled as well, and notifications sent over HTTP are pushed
+            rv = host.get('/notifications?game_since=1')
+            self.assertEqual([n['name'] for n in rv.get_json()], ['guess', 'turn_started'])
+            with self.app.test_client() as latecomer:
+                latecomer.post('/register', data={'username': 'TestLatecomer'})
+                latecomer.get('/join_game/' + token)
+            received = host_socket.get_received('/game')
+            self.assertEqual(received[-1]['args'][0]['name'], 'new_player_joined')
 
     def test_join_game(self):
         ''' test creation of join links '''
@@ -134,9 +302,11 @@ class AuthModuleCase(unittest.TestCase):
             self.assertIn(b'TestHost', rv.data)
             self.assertIn(b'TestUser', rv.data)
 
-            # should be notifications ready for the host
-            self.assertEqual(u.notifications.filter_by(name='new_player_joined').count(), 1)
-            notification = u.notifications.filter_by(name='new_player_joined').first()
+            # should be a single game notification ready for the host
+            self.assertEqual(g.notifications.filter_by(name='new_player_joined').count(), 1)
+            self.assertEqual(u.notifications.count(), 0)
+            notification = Notification.page(u.id, 0, g.id, 0)[0]
+            self.assertEqual(notification.name, 'new_player_joined')
             self.assertEqual(notification.get_data()['username'], 'TestUser')
 
             # current user should be added as player
@@ -147,11 +317,284 @@ class AuthModuleCase(unittest.TestCase):
 
             # if a user accidentally clicks the join button, (s)he should remain host and not become a player
             rv = c.post(url_for('auth.create_game'), data=dict(name = "TestGame2"), follow_redirects=True)
-            token = re.search(b'href=".+\/join_game\/(.+)"', rv.data).groups()[0]
+            token = re.search(rb'href=".+\/join_game\/(.+)"', rv.data).groups()[0]
             rv = c.get(url_for('auth.join_game', token=token), follow_redirects=True)
             self.assertEqual(current_user.role, self.app.config['ROLES']['HOST'])
 
 
+    def test_game_notifications(self):
+        ''' tests that joining a game writes a single notification read by all players '''
+        g = Game(name="TestGame")
+        players = [User(username="TestPlayer%d" % i) for i in range(3)]
+        for player in players:
+            g.players.append(player)
+        g.set_host(players[0])
+        db.session.add(g)
+        db.session.commit()
+
+        with self.app.test_client() as c:
+            self.login(c)
+            rv = c.get(url_for('auth.join_game', token=g.get_join_token()), follow_redirects=True)
+            self.assertEqual(Notification.query.count(), 1)
+            notification = g.notifications.first()
+            self.assertEqual(notification.seq, 1)
+            for player in players:
+                self.assertEqual(Notification.page(player.id, 0, g.id, 0), [notification])
+
+            # the lobby already lists the new player, so the client starts after this notification
+            self.assertIn(b'game: 1,', rv.data)
+
+    def test_notification_pages(self):
+        ''' tests that notifications are paged by sequence number per channel '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        db.session.add(g)
+        for i in range(5):
+            g.add_notification('game_notification', {'i': i})
+            u.add_notification('user_notification', {'i': i})
+        db.session.commit()
+        self.assertEqual([n.seq for n in g.notifications.order_by(Notification.seq)], [1, 2, 3, 4, 5])
+
+        # notifications written in the same clock tick are not skipped
+        g.notifications.update({'timestamp': 1.0})
+        db.session.commit()
+        page = Notification.page(u.id, 0, g.id, 3, limit=2)
+        self.assertEqual([(n.channel, n.seq) for n in page if n.channel == 'game'], [('game', 4), ('game', 5)])
+        self.assertEqual([(n.channel, n.seq) for n in page if n.channel == 'user'], [('user', 1), ('user', 2)])
+        self.assertEqual(Notification.page(u.id, 5, g.id, 5), [])
+
+    def test_notifications_without_database(self):
+        ''' tests that notifications are delivered through the broker when they are not stored '''
+        self.app.config['NOTIFICATIONS_DURABLE'] = False
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        db.session.add(g)
+        db.session.commit()
+
+        with self.app.test_client() as c:
+            self.login(c)
+            c.get(url_for('auth.join_game', token=g.get_join_token()))
+            self.assertEqual(Notification.query.count(), 0)
+            rv = c.get(url_for('main.notifications') + '?game_since=0')
+            self.assertEqual(rv.get_json()[0]['name'], 'new_player_joined')
+            self.assertEqual(rv.get_json()[0]['seq'], 1)
+
+    def test_notifications_from_other_workers(self):
+        ''' tests that notifications the broker did not see are read from the database after the ttl '''
+        self.app.extensions['broker'].ttl = 0.05
+        with self.app.test_client() as c:
+            self.login(c)
+            self.assertEqual(c.get('/notifications?user_since=0').get_json(), [])
+            # written by another worker, so it is not published to this broker
+            current_user.add_notification('test_notification', {})
+            db.session.info.pop('pending_events')
+            db.session.commit()
+            sleep(0.1)
+            rv = c.get('/notifications?user_since=0')
+            self.assertEqual([n['name'] for n in rv.get_json()], ['test_notification'])
+
+    def test_lobby_queries(self):
+        ''' tests that the number of queries to render the lobby does not grow with the players,
+        and that the player list is cached until a player joins '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        db.session.add(g)
+        db.session.commit()
+
+        with self.app.test_client() as c:
+            self.login(c)
+            c.get(url_for('auth.join_game', token=g.get_join_token()))
+            c.get(url_for('auth.lobby'))
+            self.app.extensions['caches']['lobby_players'].clear()
+            db.session.remove()
+            with count_queries() as statements:
+                rv = c.get(url_for('auth.lobby'))
+            self.assertEqual(rv.data.split(b'id="player_list"')[1].split(b'</ul>')[0].count(b'(Host)'), 1)
+            # the game and its players, the current user is cached
+            self.assertEqual(len(statements), 2)
+
+            # the players are not loaded again once the player list is cached, only when they were last seen
+            db.session.remove()
+            with count_queries() as cached_statements:
+                cached = c.get(url_for('auth.lobby'))
+            self.assertFalse([s for s in cached_statements if 'user.username' in s])
+            # the game, when its players were last seen, and the sequence number of the current user
+            self.assertEqual(len(cached_statements), 3)
+            self.assertEqual(cached.data, rv.data)
+
+            g = Game.query.filter_by(name="TestGame").first()
+            for i in range(30):
+                g.players.append(User(username="TestPlayer%d" % i))
+            g.players_changed()
+            db.session.commit()
+            token = g.get_join_token()
+            db.session.remove()
+            with count_queries() as more_statements:
+                rv = c.get(url_for('auth.lobby'))
+            self.assertIn(b'TestPlayer29', rv.data)
+            self.assertEqual(len(more_statements), len(statements))
+
+            # a player joining through a link shows up without a manual invalidation
+            with self.app.test_client() as other:
+                other.post('/register', data={'username': 'LatePlayer'})
+                other.get('/join_game/' + token)
+            self.assertIn(b'LatePlayer', c.get('/index').data)
+
+    def test_join_qrcode(self):
+        ''' tests that the QR code is served from a cacheable url per token epoch '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        db.session.add(g)
+        db.session.commit()
+        self.assertEqual(g.get_join_token(epoch=Game.token_epoch()), g.get_join_token(epoch=Game.token_epoch()))
+
+        with self.app.test_client() as c:
+            self.login(c)
+            rv = c.get(url_for('auth.join_qrcode', game_id=g.id, epoch=Game.token_epoch()))
+            self.assertEqual(rv.status_code, 404) # not a player yet
+
+            rv = c.get(url_for('auth.join_game', token=g.get_join_token()), follow_redirects=True)
+            url = re.search(rb'<img src="([^"]+\.png)"', rv.data).groups()[0].decode()
+            rv = c.get(url)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.mimetype, 'image/png')
+            self.assertTrue(rv.data.startswith(b'\x89PNG'))
+            self.assertIn('private', rv.headers['Cache-Control'])
+
+            rv = c.get(url, headers={'If-None-Match': rv.headers['ETag']})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(len(self.app.extensions['caches']['qrcodes']), 1)
+
+    def test_join_token_cache(self):
+        ''' tests that verified join tokens are cached until they expire '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        db.session.add(g)
+        db.session.commit()
+        token = g.get_join_token()
+        self.assertEqual(Game.verify_join_token(token), g)
+
+        db.session.remove()
+        with count_queries() as statements:
+            game = Game.verify_join_token(token)
+            self.assertEqual(game.name, "TestGame")
+            self.assertIsNone(Game.verify_join_token('SomeTokenThatDoesNotWork'))
+        self.assertEqual(statements, [])
+        self.assertEqual(game.players.count(), 1)
+
+        # tokens are only cached until they expire
+        token = g.get_join_token(1)
+        self.assertIsNotNone(Game.verify_join_token(token))
+        expires, _ = self.app.extensions['caches']['join_tokens'].items[token]
+        self.assertLessEqual(expires - monotonic(), 1)
+
+        # a database error is not cached as an invalid token
+        token = g.get_join_token()
+        with patch.object(Game.query_class, 'get', side_effect=OperationalError('SELECT', {}, 'database is locked')):
+            self.assertRaises(OperationalError, Game.verify_join_token, token)
+        self.assertEqual(Game.verify_join_token(token).id, g.id)
+
+    def test_user_cache(self):
+        ''' tests that logged in users are cached until their role, team or game changes '''
+        g = Game(name="TestGame")
+        db.session.add(g)
+        db.session.commit()
+        game_id, token = g.id, g.get_join_token()
+        with self.app.test_client() as c:
+            self.login(c)
+            c.get(url_for('main.notifications'))
+            db.session.remove()
+            with count_queries() as statements:
+                rv = c.get(url_for('main.notifications'))
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse([s for s in statements if 'FROM user' in s])
+            cache = self.app.extensions['caches']['users']
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # joining a game drops the user from the cache
+            c.get(url_for('auth.join_game', token=token))
+            self.assertEqual(len(cache), 0)
+            db.session.remove()
+            c.get(url_for('main.notifications'))
+            self.assertEqual(cache.get(current_user.id)[1]['game_id'], game_id)
+
+    def test_user_cache_workers(self):
+        ''' tests that a change of the user of a session is seen by the other workers '''
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+            workers = [create_app(FileConfig) for _ in range(2)]
+            with workers[0].app_context():
+                db.create_all()
+                g = Game(name="TestGame")
+                db.session.add(g)
+                db.session.commit()
+                token = g.get_join_token()
+                db.session.remove()
+            a, b = [worker.test_client() for worker in workers]
+            self.login(a)
+            for cookie in a.cookie_jar:
+                b.set_cookie('localhost', cookie.name, cookie.value)
+            # worker b caches the user without a game
+            self.assertIn(b'No game selected', b.get('/index').data)
+            a.get('/join_game/' + token)
+            for cookie in a.cookie_jar:
+                b.set_cookie('localhost', cookie.name, cookie.value)
+            self.assertNotIn(b'No game selected', b.get('/index').data)
+            for worker in workers:
+                with worker.app_context():
+                    db.session.remove()
+                    db.engine.dispose()
+
+    def test_presence(self):
+        ''' tests that polling marks users as online without writing to the database each time '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost", last_seen=datetime.utcnow() - timedelta(hours=1))
+        g.set_host(u)
+        db.session.add(g)
+        db.session.commit()
+
+        with self.app.test_client() as c:
+            self.login(c)
+            rv = c.get(url_for('auth.join_game', token=g.get_join_token()), follow_redirects=True)
+            self.assertIn(b'away', rv.data) # the host
+            self.assertIn(b'online', rv.data) # the current user
+
+            with count_queries() as statements:
+                c.get(url_for('main.notifications'))
+            self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+            self.assertIn(current_user.id, self.app.extensions['presence'].dirty)
+
+            # all users seen since the last flush are written in one statement
+            with count_queries() as statements:
+                self.assertEqual(presence.flush(), 1)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(presence.flush(), 0)
+
+    def test_prune_notifications(self):
+        ''' tests that expired notifications and notifications of abandoned games are pruned in batches '''
+        g = Game(name="TestGame")
+        u = User(username="TestHost")
+        g.set_host(u)
+        abandoned = Game(name="AbandonedGame")
+        db.session.add_all([g, abandoned])
+        for i in range(5):
+            g.add_notification('old_notification', {'i': i}).timestamp = time() - 7200
+            u.add_notification('old_notification', {'i': i}).timestamp = time() - 7200
+        g.add_notification('new_notification', {})
+        abandoned.add_notification('new_notification', {})
+        db.session.commit()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['notifications', 'prune', '--max-age', '3600', '--batch-size', '3'])
+        self.assertIn('Removed 11 notifications', result.output)
+        self.assertEqual([n.name for n in Notification.query], ['new_notification'])
+
     def test_join_game_with_same_username(self):
         ''' tests that a user cannot join a game with an existing username '''
          # create a test game and host and store in db
@@ -176,6 +619,32 @@ class AuthModuleCase(unittest.TestCase):
             self.assertEqual(g.players.count(), 2) # should be added as user
             self.assertIn("DifferentUser", [x.username for x in g.players])
 
+    def test_unique_names(self):
+        ''' tests that the database keeps names unique when the form validation is passed by '''
+        g = Game(name="TestGame")
+        g.set_host(User(username="TestUser"))
+        db.session.add(g)
+        db.session.commit()
+        token = g.get_join_token()
+
+        with self.app.test_client() as c:
+            # registered without the join link, so the name was not checked against the game
+            self.login(c)
+            rv = c.get(url_for('auth.join_game', token=token))
+            self.assertIn('/register?next=', rv.location)
+            self.assertFalse(current_user.is_authenticated)
+            self.assertEqual(g.players.count(), 1)
+
+            self.login(c)
+            c.post(url_for('auth.create_game'), data={'name': 'AnotherGame'})
+            db.session.add(Game(name='RacingGame'))
+            db.session.commit()
+            with patch.object(CreateGameForm, 'validate_name', lambda form, name: None):
+                rv = c.post(url_for('auth.create_game'), data={'name': 'RacingGame'})
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn(b'This name already exists', rv.data)
+            self.assertEqual(Game.query.filter_by(name='RacingGame').count(), 1)
+
 
     def test_set_game_settings(self):
         ''' Tests the settings to configure a game '''
@@ -211,6 +680,575 @@ class AuthModuleCase(unittest.TestCase):
             for setting in settings:
                 self.assertEqual(int(setting.value), test_settings[setting.key])
 
+    def test_settings_cache(self):
+        ''' tests that the settings of a game are loaded at once and cached until they change '''
+        g = Game(name="TestGame")
+        db.session.add(g)
+        g.update_settings(dict(num_rounds=3, num_cards=5, round_time=50))
+        db.session.commit()
+
+        with count_queries() as statements:
+            self.assertEqual(g.get_settings(), dict(num_rounds=3, num_cards=5, round_time=50))
+            self.assertEqual(g.setting('round_time'), 50)
+        # loading the game row and the settings
+        self.assertEqual(len(statements), 2)
+
+        g.update_settings(dict(num_rounds=4, num_cards=5, round_time=60))
+        db.session.commit()
+        self.assertEqual(g.setting('round_time'), 60)
+        self.assertEqual(g.settings.count(), 3)
+
+    def test_metrics(self):
+        ''' tests that queries, timings and response sizes are exported per endpoint '''
+        with self.app.test_client() as c:
+            self.login(c)
+            c.post('/create_game', data={'name': 'TestGame'})
+            db.session.remove()
+            with count_queries() as statements:
+                rv = c.get(url_for('auth.lobby'))
+            size = len(rv.data)
+
+            rv = c.get('/metrics')
+            self.assertEqual(rv.status_code, 200)
+            text = rv.data.decode()
+            self.assertIn('witm_requests_total{endpoint="auth.lobby"} 1\n', text)
+            self.assertIn('witm_sql_queries_total{endpoint="auth.lobby"} %d\n' % len(statements), text)
+            self.assertIn('witm_response_bytes_total{endpoint="auth.lobby"} %d\n' % size, text)
+            self.assertIn('witm_request_duration_seconds_count{endpoint="auth.lobby"} 1\n', text)
+            self.assertIn('witm_cache_hits_total{cache="users"}', text)
+
+            self.app.config['METRICS_TOKEN'] = 'secret'
+            self.assertEqual(c.get('/metrics').status_code, 403)
+            rv = c.get('/metrics', headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(rv.status_code, 200)
+
+
+    def test_rounds(self):
+        ''' tests that the host starts rounds that the server ends on time, once '''
+        with self.app.test_client() as c:
+            self.login(c)
+            c.post('/create_game', data={'name': 'TestGame'})
+            c.post('/init_game', data={'num_cards': 3, 'num_rounds': 1, 'round_time': 30})
+            rv = c.post('/start_round')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()['round'], 1)
+            ends_at = rv.get_json()['ends_at']
+            # the round is running
+            self.assertEqual(c.post('/start_round').status_code, 409)
+
+        game = Game.query.filter_by(name='TestGame').first()
+        self.assertEqual(rounds.scheduler.next_deadline(), ends_at)
+        self.assertFalse(rounds.end_round(game.id, now=ends_at - 1))
+        self.assertTrue(rounds.end_round(game.id, now=ends_at))
+        self.assertFalse(rounds.end_round(game.id, now=ends_at))
+        n = game.notifications.order_by(Notification.seq.desc()).first()
+        self.assertEqual((n.name, n.get_data()), ('round_ended', {'guessed': 0, 'round': 1, 'last': True}))
+
+        # a restarted worker picks up running rounds
+        game.round_ends_at = ends_at
+        db.session.commit()
+        rounds.scheduler.cancel(game.id)
+        self.assertEqual(rounds.recover(), 1)
+        # after the worker that started the round
+        self.assertEqual(rounds.scheduler.pop_due(now=ends_at), [])
+        self.assertEqual(rounds.scheduler.pop_due(now=ends_at + self.app.config['ROUND_RECOVERY_GRACE']), [game.id])
+
+
+    def test_select_teams(self):
+        ''' tests that the host divides the players over balanced teams in one statement '''
+        g = Game(name="TestGame")
+        g.set_host(User(username="TestHost"))
+        for i in range(8):
+            g.players.append(User(username="TestPlayer%d" % i))
+        db.session.add(g)
+        db.session.commit()
+        host_id = g.get_host().id
+
+        with self.app.test_client() as c:
+            with c.session_transaction() as session:
+                session['_user_id'] = str(host_id)
+            rv = c.post('/select_teams', data={'num_teams': 3, 'keep_apart': 'TestPlayer0, Nobody'})
+            self.assertIn(b'Not a pair of players', rv.data)
+            rv = c.post('/select_teams', data={'num_teams': 2, 'keep_apart': 'TestHost, TestPlayer0\nTestPlayer0, TestPlayer1\nTestPlayer1, TestHost'})
+            self.assertIn(b'cannot be kept apart', rv.data)
+
+            c.get(url_for('auth.lobby'))
+            with count_queries() as statements:
+                rv = c.post('/select_teams', data={'num_teams': 3, 'keep_apart': 'TestHost, TestPlayer0\n'})
+            self.assertEqual(rv.status_code, 302)
+            self.assertEqual(sum(s.startswith('UPDATE user SET team') for s in statements), 1)
+            # the cached identity of the host is dropped
+            self.assertIsNone(user_cache().get(host_id))
+
+        players = User.query.all()
+        sizes = [sum(u.team == team for u in players) for team in (1, 2, 3)]
+        self.assertEqual(sorted(sizes), [3, 3, 3])
+        teams = {u.username: u.team for u in players}
+        self.assertNotEqual(teams['TestHost'], teams['TestPlayer0'])
+
+    def test_card_settings(self):
+        ''' tests that players write the number of cards the host chose, not the number of rounds '''
+        with self.app.test_client() as c:
+            self.login(c)
+            c.post('/create_game', data={'name': 'TestGame'})
+            rv = c.get('/init_game')
+            self.assertRegex(rv.data.decode(), r'(?s)for="num_cards">Number of cards<.*for="num_rounds">Number of rounds<')
+            rv = c.post('/init_game', data={'num_cards': 3, 'num_rounds': 12, 'round_time': 30})
+            self.assertEqual(rv.status_code, 302)
+            self.assertEqual(Game.query.filter_by(name='TestGame').first().get_settings(),
+                             dict(num_cards=3, num_rounds=12, round_time=30))
+            rv = c.get('/enter_cards')
+            self.assertIn(b'cards-2', rv.data)
+            self.assertNotIn(b'cards-3', rv.data)
+
+    def test_cards(self):
+        ''' tests that cards are drawn from the deck of a round and written when it ends '''
+        with self.app.test_client() as c:
+            self.login(c)
+            c.post('/create_game', data={'name': 'TestGame'})
+            c.post('/init_game', data={'num_cards': 2, 'num_rounds': 2, 'round_time': 30})
+            rv = c.get('/enter_cards')
+            self.assertIn(b'cards-1', rv.data)
+            self.assertNotIn(b'cards-2', rv.data)
+            rv = c.post('/enter_cards', data={'cards-0': 'Napoleon', 'cards-1': 'Cleopatra'})
+            self.assertEqual(rv.status_code, 302)
+            game = Game.query.filter_by(name='TestGame').first()
+            self.assertEqual(sorted(card.text for card in game.cards), ['Cleopatra', 'Napoleon'])
+            game_id = game.id
+            ends_at = c.post('/start_round').get_json()['ends_at']
+
+            socket = socketio.test_client(self.app, namespace='/game', flask_test_client=c)
+            first = socket.emit('draw_card', namespace='/game', callback=True)
+            socket.emit('put_back', first['id'], namespace='/game')
+            with count_queries() as statements:
+                drawn = [socket.emit('draw_card', namespace='/game', callback=True) for _ in range(2)]
+            # drawing does not touch the database
+            self.assertEqual(statements, [])
+            self.assertEqual(sorted(card['text'] for card in drawn), ['Cleopatra', 'Napoleon'])
+            self.assertIn('error', socket.emit('draw_card', namespace='/game', callback=True))
+            socket.emit('put_back', drawn[1]['id'], namespace='/game')
+            self.assertIn('seq', socket.emit('card_guessed', drawn[0]['id'], namespace='/game', callback=True))
+            self.assertIn('error', socket.emit('card_guessed', drawn[0]['id'], namespace='/game', callback=True))
+
+        self.assertTrue(rounds.end_round(game_id, now=ends_at))
+        guessed = Card.query.filter(Card.guessed_round.isnot(None)).all()
+        self.assertEqual([(card.text, card.guessed_round) for card in guessed], [(drawn[0]['text'], 1)])
+
+        # the next round deals the cards that were not guessed
+        rounds.start_round(Game.query.get(game_id))
+        self.assertEqual(list(decks.get(game_id).texts.values()), [drawn[1]['text']])
+
+        # another worker without the deck ends the round first
+        card_id = next(iter(decks.get(game_id).texts))
+        decks.get(game_id).draw()
+        decks.get(game_id).guess(card_id, 1)
+        deck = self.app.extensions['decks'].pop(game_id)
+        ends_at = Game.query.get(game_id).round_ends_at
+        self.assertTrue(rounds.end_round(game_id, now=ends_at))
+        self.app.extensions['decks'][game_id] = deck
+        self.assertFalse(rounds.end_round(game_id, now=ends_at))
+        self.assertEqual(Card.query.get(card_id).guessed_round, 2)
+        self.assertIsNone(decks.get(game_id))
+
+
+class BrokerCase(unittest.TestCase):
+
+    def event(self, seq, timestamp=None):
+        return Event('game', 1, seq, 'test_event', '{"seq": %d}' % seq, timestamp or time())
+
+    def test_memory_backend(self):
+        ''' tests that the memory backend only returns complete runs of events '''
+        backend = MemoryBackend(history=3)
+        self.assertIsNone(backend.read(('game', 1), 0))
+        backend.seed(('game', 1), 0)
+        backend.publish([self.event(1), self.event(3)])
+        # event 2 may still be committed, so it is waited for
+        self.assertEqual([e.seq for e in backend.read(('game', 1), 0)], [1])
+        backend.publish([self.event(2), self.event(4)])
+        self.assertEqual([e.seq for e in backend.read(('game', 1), 1)], [2, 3, 4])
+        self.assertEqual(backend.head(('game', 1)), 4)
+        # event 1 has been dropped from the history
+        self.assertIsNone(backend.read(('game', 1), 0))
+
+    def test_memory_backend_gap_timeout(self):
+        ''' tests that a gap that is never filled is skipped after a while '''
+        backend = MemoryBackend(gap_timeout=5)
+        backend.seed(('game', 1), 0)
+        backend.publish([self.event(2, time() - 10)])
+        self.assertEqual([e.seq for e in backend.read(('game', 1), 0)], [2])
+
+    def test_memory_backend_ttl(self):
+        ''' tests that the memory backend stops trusting a channel after the ttl '''
+        backend = MemoryBackend(ttl=0.05)
+        backend.seed(('game', 1), 0)
+        backend.publish([self.event(1)])
+        self.assertEqual(backend.head(('game', 1)), 1)
+        sleep(0.1)
+        self.assertIsNone(backend.head(('game', 1)))
+        self.assertIsNone(backend.read(('game', 1), 1))
+
+    def test_memory_backend_idle(self):
+        ''' tests that idle channels are forgotten without pruning '''
+        backend = MemoryBackend(max_idle=0.05)
+        backend.seed(('game', 1), 0)
+        backend.publish([self.event(1)])
+        sleep(0.1)
+        backend.seed(('game', 2), 0)
+        self.assertEqual(list(backend.histories), [('game', 2)])
+
+    def test_file_backend(self):
+        ''' tests that workers with a file backend in the same directory share events '''
+        with tempfile.TemporaryDirectory() as directory:
+            publisher, subscriber = FileBackend(directory), FileBackend(directory)
+            self.assertIsNone(subscriber.head(('game', 1)))
+            events = [self.event(1), self.event(2)]
+            publisher.publish(events)
+            self.assertEqual(subscriber.read(('game', 1), 0), events)
+            subscriber.wait({('game', 1): 1}, timeout=0.1)
+            publisher.publish([self.event(3)])
+            subscriber.wait({('game', 1): 2}, timeout=1)
+            self.assertEqual(subscriber.head(('game', 1)), 3)
+
+    def test_file_backend_idle(self):
+        ''' tests that the files of idle channels are removed without pruning '''
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileBackend(directory, max_idle=0.05)
+            backend.publish([self.event(1)])
+            sleep(0.1)
+            backend.publish([Event('game', 2, 1, 'test_event', '{}', time())])
+            self.assertEqual(os.listdir(directory), ['game-2.log'])
+            self.assertIsNone(backend.head(('game', 1)))
+
+
+class ShardCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        class ShardConfig(TestConfig):
+            NOTIFICATION_SHARDS = 2
+            NOTIFICATION_SHARD_URL = 'sqlite:///' + os.path.join(self.directory.name, 'notifications-{}.db')
+        self.app = create_app(ShardConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        for engine in self.app.extensions['notification_shards'].engines:
+            engine.dispose()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def test_notification_shards(self):
+        ''' tests that notifications are stored in the shard of their game and read from there '''
+        games = [Game(name="TestGame%d" % i) for i in range(2)]
+        u = User(username="TestHost")
+        games[0].set_host(u)
+        db.session.add_all(games)
+        games[0].add_notification('first_notification', {})
+        games[1].add_notification('other_notification', {})
+        u.add_notification('user_notification', {})
+        db.session.commit()
+
+        self.assertEqual(Notification.query.count(), 0)
+        shards = self.app.extensions['notification_shards']
+        for g in games:
+            with shards.engine(g.id).connect() as connection:
+                rows = connection.execute('SELECT game_id FROM notification WHERE game_id IS NOT NULL').fetchall()
+            self.assertEqual(rows, [(g.id,)])
+
+        # the broker does not know these channels, so they are read from the shards
+        self.app.extensions['broker'].histories.clear()
+        with self.app.test_client() as c:
+            with c.session_transaction() as session:
+                session['_user_id'] = str(u.id)
+            rv = c.get('/notifications?game_since=0&user_since=0')
+        self.assertEqual(sorted(n['name'] for n in rv.get_json()), ['first_notification', 'user_notification'])
+        self.assertEqual(Notification.channel_head('game', games[0].id), 1)
+
+        # the second game has no players
+        removed, seconds = prune_notifications(3600)
+        self.assertEqual(removed, 1)
+        self.assertEqual(Notification.channel_page('game', games[1].id), [])
+
+    def test_shard_sequence(self):
+        ''' tests that sending notifications only writes to the shard of their channel '''
+        g = Game(name="TestGame")
+        db.session.add(g)
+        db.session.commit()
+        game_id = g.id
+        db.session.remove()
+        with count_queries() as statements:
+            game = Game.query.get(game_id)
+            game.add_notification('first_notification', {})
+            game.add_notification('second_notification', {})
+            db.session.commit()
+        self.assertEqual([s for s in statements if not s.startswith('SELECT')], [])
+        self.assertEqual([n.seq for n in Notification.channel_page('game', game_id)], [1, 2])
+        self.assertEqual(Game.query.get(game_id).last_seq, 0)
+        self.assertEqual(Game.query.get(game_id).sent_seq, 2)
+
+        # the counter is read when the broker does not know the channel
+        self.app.extensions['broker'].histories.clear()
+        with self.app.test_request_context():
+            self.assertEqual(broker.head('game', game_id), 2)
+        Game.query.get(game_id).add_notification('third_notification', {})
+        db.session.commit()
+        self.assertEqual(Notification.channel_head('game', game_id), 3)
+
+    def test_failed_shard_write(self):
+        ''' tests that a failed shard write fails the commit and leaves no notification behind '''
+        games = [Game(name="TestGame%d" % i) for i in range(2)]
+        db.session.add_all(games)
+        db.session.commit()
+        ids = [g.id for g in games]
+        shards = self.app.extensions['notification_shards']
+        # the shard of the first game is written last
+        Notification.__table__.drop(shards.engine(ids[0]))
+        for g in games:
+            g.add_notification('test_notification', {})
+        with self.assertRaises(Exception):
+            db.session.commit()
+        db.session.rollback()
+
+        self.assertEqual([g.last_seq for g in Game.query.order_by(Game.id)], [0, 0])
+        self.assertEqual(Notification.channel_head('game', ids[1]), 0)
+        self.assertIsNone(self.app.extensions['broker'].head(('game', ids[1])))
+
+        # the sequence numbers are used again once the shard is back
+        Notification.__table__.create(shards.engine(ids[0]))
+        for g in Game.query.order_by(Game.id):
+            g.add_notification('test_notification', {})
+        db.session.commit()
+        self.assertEqual([[n.seq for n in Notification.channel_page('game', id)] for id in ids], [[1], [1]])
+
+
+class DatabaseCase(unittest.TestCase):
+
+    def test_engine_options(self):
+        ''' tests that the database profile is picked by the URL '''
+        config = {key: getattr(Config, key) for key in dir(Config) if key.isupper()}
+        config.update(SQLALCHEMY_DATABASE_URI='postgresql://localhost/witm', SQLALCHEMY_ENGINE_OPTIONS={'echo': True})
+        options = engine_options(config)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('statement_timeout=5000', options['connect_args']['options'])
+        self.assertTrue(options['echo'])
+        config.update(DATABASE_PROFILE='default')
+        self.assertEqual(engine_options(config), {'echo': True})
+
+    def test_sqlite_profile(self):
+        ''' tests that connections to a SQLite file use WAL and wait for locks '''
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'test.db')
+            app = create_app(FileConfig)
+            with app.app_context():
+                self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+                db.session.remove()
+                db.get_engine(app).dispose()
+
+
+class LazyCase(unittest.TestCase):
+
+    def test_lazy_extension(self):
+        ''' tests that a lazy extension is initialised for each app when it is first used '''
+        apps = [create_app(TestConfig) for _ in range(2)]
+        for app in apps:
+            with app.app_context():
+                self.assertIsNotNone(mail.send)
+                self.assertIn('mail', app.extensions)
+                self.assertNotIn('lazy_mail', app.extensions)
+        self.assertIsNot(apps[0].extensions['mail'], apps[1].extensions['mail'])
+
+    def test_render_imports(self):
+        ''' tests that rendering a page does not import the slow extensions '''
+        script = ('import sys, tests\n'
+                  'app = tests.create_app(tests.TestConfig)\n'
+                  'app.test_client().get("/register")\n'
+                  'print([m for m in ("flask_moment", "flask_migrate", "flask_mail") if m in sys.modules])')
+        output = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip().splitlines()[-1], '[]')
+
+
+class LogCase(unittest.TestCase):
+
+    def test_log_pipeline(self):
+        ''' tests that records are written as JSON lines with the request they were logged in '''
+        class LogConfig(TestConfig):
+            LOG_DIR = tempfile.mkdtemp()
+        app = create_app(LogConfig)
+        log_pipeline.start(app)
+
+        @app.route('/fail')
+        def fail():
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                app.logger.exception('Failed for %s', 'test')
+            return ''
+
+        with app.test_client() as c:
+            rv = c.get('/fail', headers={'X-Request-ID': 'abc123'})
+            self.assertEqual(rv.headers['X-Request-ID'], 'abc123')
+            self.assertEqual(len(c.get('/fail').headers['X-Request-ID']), 32)
+        log_pipeline.stop(app)
+
+        with open(os.path.join(LogConfig.LOG_DIR, 'who-is-the-man.log')) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(entries[0]['message'], 'App started up')
+        self.assertEqual(entries[1]['message'], 'Failed for test')
+        self.assertEqual(entries[1]['level'], 'ERROR')
+        self.assertEqual(entries[1]['request_id'], 'abc123')
+        self.assertEqual(entries[1]['endpoint'], 'fail')
+        self.assertGreaterEqual(entries[1]['duration'], 0)
+        self.assertIn('ZeroDivisionError', entries[1]['exception'])
+
+    def test_batching_smtp_handler(self):
+        ''' tests that errors are mailed at most once per interval, in batches '''
+        handler = BatchingSMTPHandler(mailhost='localhost', fromaddr='no-reply@localhost',
+                                      toaddrs=['admin@localhost'], subject='Errors',
+                                      interval=0.2, capacity=3)
+        with patch('smtplib.SMTP') as smtp:
+            for i in range(6):
+                handler.handle(logging.makeLogRecord({'msg': 'error %d' % i, 'levelno': logging.ERROR}))
+            # the first error right away, the next ones when the interval has passed
+            self.assertEqual(smtp.return_value.send_message.call_count, 1)
+            sleep(0.4)
+            self.assertEqual(smtp.return_value.send_message.call_count, 2)
+            body = smtp.return_value.send_message.call_args[0][0].get_content()
+            self.assertIn('error 3', body)
+            self.assertNotIn('error 4', body)
+            self.assertIn('and 2 more', body)
+            handler.close()
+            self.assertEqual(smtp.return_value.send_message.call_count, 2)
+
+
+class TeamsCase(unittest.TestCase):
+
+    def test_assign_teams(self):
+        ''' tests that teams differ at most one player in size and keep pairs apart '''
+        for n in range(1, 40):
+            teams = assign_teams(range(n), 4, apart=[(0, 1), (1, 2), (0, 2)], seed=n)
+            sizes = [list(teams.values()).count(t) for t in range(1, 5)]
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+            if n >= 3:
+                self.assertEqual(len({teams[0], teams[1], teams[2]}), 3)
+        self.assertRaises(ValueError, assign_teams, range(4), 2, apart=[(0, 1), (1, 2), (0, 2)])
+
+    def test_assign_teams_feasible(self):
+        ''' tests that pairs that can be kept apart always are, whatever the seed '''
+        from itertools import combinations, product
+        import random
+
+        def feasible(n, num_teams, apart):
+            small = n // num_teams
+            for assignment in product(range(num_teams), repeat=n):
+                sizes = [assignment.count(t) for t in range(num_teams)]
+                if min(sizes) >= small and max(sizes) <= small + 1 and \
+                        all(assignment[a] != assignment[b] for a, b in apart):
+                    return True
+            return False
+
+        cases = [(7, 2, [(3, 6), (0, 3), (4, 6), (0, 1), (5, 6)])]
+        generator = random.Random(0)
+        for _ in range(150):
+            n, num_teams = generator.randint(2, 7), generator.randint(2, 3)
+            pairs = list(combinations(range(n), 2))
+            cases.append((n, num_teams, generator.sample(pairs, generator.randint(1, min(len(pairs), 6)))))
+        for n, num_teams, apart in cases:
+            if not feasible(n, num_teams, apart):
+                self.assertRaises(ValueError, assign_teams, range(n), num_teams, apart)
+                continue
+            for seed in range(20):
+                teams = assign_teams(range(n), num_teams, apart, seed=seed)
+                self.assertTrue(all(teams[a] != teams[b] for a, b in apart))
+                sizes = [list(teams.values()).count(t) for t in range(1, num_teams + 1)]
+                self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+
+class DeckCase(unittest.TestCase):
+
+    def test_deck(self):
+        ''' tests drawing every card once, returning cards to the pile and guessing them '''
+        deck = Deck([(i, 'card %d' % i) for i in range(100)], round=1)
+        drawn = [deck.draw() for _ in range(100)]
+        self.assertEqual(sorted(drawn), [(i, 'card %d' % i) for i in range(100)])
+        self.assertIsNone(deck.draw())
+        deck.put_back(5)
+        deck.put_back(5)
+        self.assertEqual(len(deck), 1)
+        self.assertTrue(deck.guess(7, user_id=1))
+        self.assertFalse(deck.guess(7, user_id=1))
+        deck.put_back(7)
+        self.assertEqual(deck.draw(), (5, 'card 5'))
+        self.assertEqual(deck.guessed, {7: 1})
+
+
+class SchedulerCase(unittest.TestCase):
+
+    def test_scheduler(self):
+        ''' tests that timers fire in order of their deadline, once, unless cancelled '''
+        scheduler = Scheduler(None)
+        scheduler.schedule(1, 30)
+        scheduler.schedule(2, 10)
+        scheduler.schedule(3, 20)
+        scheduler.schedule(1, 15) # rescheduled
+        scheduler.cancel(3)
+        self.assertEqual(scheduler.next_deadline(), 10)
+        self.assertEqual(scheduler.pop_due(now=5), [])
+        self.assertEqual(scheduler.pop_due(now=25), [2, 1])
+        self.assertEqual(scheduler.pop_due(now=100), [])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_scheduler_thread(self):
+        ''' tests that the scheduler thread wakes up for an earlier timer '''
+        fired = []
+        scheduler = Scheduler(fired.append)
+        scheduler.start()
+        scheduler.schedule('late', time() + 60)
+        scheduler.schedule('soon', time() + 0.05)
+        deadline = time() + 2
+        while not fired and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(fired, ['soon'])
+
+    def test_scheduler_start(self):
+        ''' tests that the scheduler is started by the first request, not by creating the app '''
+        class ServerConfig(TestConfig):
+            TESTING = False
+            ROUND_SCHEDULER = True
+            LOG_DIR = tempfile.mkdtemp()
+        app = create_app(ServerConfig)
+        try:
+            with app.app_context():
+                db.create_all()
+            # e.g. for flask commands
+            self.assertIsNone(app.extensions['rounds'].thread)
+            with app.test_client() as c:
+                c.get('/register')
+            self.assertTrue(app.extensions['rounds'].thread.is_alive())
+        finally:
+            log_pipeline.stop(app)
+
+    def test_pruning_start(self):
+        ''' tests that notifications are pruned from the first request on, not for flask commands '''
+        class ServerConfig(TestConfig):
+            TESTING = False
+            NOTIFICATION_PRUNE_INTERVAL = 3600
+            LOG_DIR = tempfile.mkdtemp()
+        with patch('app.retention.start_pruning') as start_pruning:
+            app = create_app(ServerConfig)
+            try:
+                with app.app_context():
+                    db.create_all()
+                start_pruning.assert_not_called()
+                with app.test_client() as c:
+                    c.get('/register')
+                start_pruning.assert_called_once_with(app)
+            finally:
+                log_pipeline.stop(app)
 
 
 if __name__ == '__main__':
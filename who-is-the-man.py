@@ -1,8 +1,14 @@
 from app import create_app, db
 from app.models import User, Game, Notification
+import os
 
 app = create_app()
 
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Game': Game, 'Notification': Notification}
+
+if __name__ == '__main__':
+    # serves the Socket.IO connections over WebSockets as well, from threads
+    from app.server import serve
+    serve(app, os.environ.get('BIND', '127.0.0.1:5000'))